@@ -0,0 +1,121 @@
+"""Compare event loop backends on a local many-small-files workload
+
+Starts a stand-in data server on localhost, then runs download_async
+against it once per backend into a scratch directory.
+
+    python benchmarks/loop_bench.py --files 2000 --size 4096 --workers 32
+"""
+import argparse
+import hashlib
+import importlib.util
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+from loguru import logger
+
+from party.cache import configure_cache
+from party.cli import download_async
+from party.common import set_etags
+from party.loop import BACKENDS, run_async, set_loop_backend
+from party.posts import Attachment
+
+
+def serve(port: int, size: int):
+    """Answer HEAD/GET for any /data path with size bytes of content"""
+    body = os.urandom(size)
+
+    async def data(request):
+        headers = {
+            "etag": hashlib.md5(request.path.encode()).hexdigest(),
+            "content-length": str(size),
+        }
+        if request.method == "HEAD":
+            return web.Response(headers=headers)
+        return web.Response(body=body, headers={"etag": headers["etag"]})
+
+    app = web.Application()
+    app.router.add_route("*", "/data/{path:.*}", data)
+    web.run_app(app, host="127.0.0.1", port=port, print=None)
+
+
+def free_port() -> int:
+    """Ask the kernel for an unused port"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def bench(backend: str, base_url: str, count: int, workers: int) -> float:
+    """Download count files with the given backend, returns seconds"""
+    set_loop_backend(backend)
+    set_etags([])
+    directory = tempfile.mkdtemp(prefix=f"party-bench-{backend}-")
+    files = [Attachment(f"{i}.bin", f"/{i:02x}/{i}.bin") for i in range(count)]
+    start = time.perf_counter()
+    run_async(
+        download_async(base_url, directory, files, workers, headless=True)
+    )
+    elapsed = time.perf_counter() - start
+    shutil.rmtree(directory)
+    return elapsed
+
+
+def available(backend: str) -> bool:
+    """Whether a backend can really be used, loop_factory falls back quietly"""
+    return (
+        backend == "default" or importlib.util.find_spec(backend) is not None
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=4096)
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument(
+        "--cache-dir",
+        help="Cache location for the run, defaults to a scratch directory "
+        "so the real size cache is left alone",
+    )
+    args = parser.parse_args()
+    cache_dir = args.cache_dir or tempfile.mkdtemp(prefix="party-bench-cache-")
+    configure_cache(directory=cache_dir)
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    port = free_port()
+    server = multiprocessing.Process(
+        target=serve, args=(port, args.size), daemon=True
+    )
+    server.start()
+    time.sleep(1)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        for backend in BACKENDS:
+            if not available(backend):
+                print(f"{backend:>8}: not installed, skipped")
+                continue
+            times = [
+                bench(backend, base_url, args.files, args.workers)
+                for _ in range(args.rounds)
+            ]
+            best = min(times)
+            print(
+                f"{backend:>8}: best {best:.2f}s "
+                f"({args.files / best:.0f} files/s) over {args.rounds} rounds"
+            )
+    finally:
+        server.terminate()
+        if not args.cache_dir:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
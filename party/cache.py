@@ -0,0 +1,256 @@
+"""On-disk cache for API responses, shared by every command"""
+import asyncio
+import hashlib
+import os
+import time
+
+from typing import Dict, Optional
+from urllib.parse import urlencode
+
+import simplejson as json
+
+from .logs import debug_event
+
+# Entries untouched for this many ttls, and at least PRUNE_AGE, are deleted
+PRUNE_TTLS = 10
+PRUNE_AGE = 7 * 24 * 60 * 60
+# Oldest entries go first once the api cache outgrows this
+MAX_BYTES = 512 * 2**20
+PRUNE_INTERVAL = 60 * 60
+
+
+def default_cache_dir() -> str:
+    """PARTY_CACHE_DIR, else $XDG_CACHE_HOME/party, else ~/.cache/party"""
+    if "PARTY_CACHE_DIR" in os.environ:
+        return os.environ["PARTY_CACHE_DIR"]
+    base = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(base, "party")
+
+
+class ResponseCache:
+    """Cache GET response bodies keyed by url and params
+
+    Entries younger than ttl seconds are served without a request. Older
+    entries are revalidated with If-None-Match/If-Modified-Since when the
+    server sent validators, so an unchanged page costs a 304. A negative
+    ttl disables the cache. Entries nobody has used for a long while, and
+    the oldest ones past max_bytes, are pruned when the cache is first used
+    and hourly after that.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        ttl: float = 600,
+        max_bytes: int = MAX_BYTES,
+    ):
+        self.directory = directory or default_cache_dir()
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.pruned: Optional[float] = None
+
+    @property
+    def enabled(self) -> bool:
+        """False when the cache is switched off"""
+        return self.ttl >= 0
+
+    @staticmethod
+    def key(url: str, params: Optional[dict] = None) -> str:
+        """Stable cache key for a url and its query params"""
+        query = urlencode(sorted((params or {}).items()))
+        return hashlib.sha256(f"{url}?{query}".encode()).hexdigest()
+
+    def filename(self, key: str) -> str:
+        """Location of an entry on disk"""
+        return os.path.join(self.directory, "api", key[:2], f"{key}.json")
+
+    def load(self, key: str) -> Optional[dict]:
+        """Read an entry, None if missing or unreadable
+
+        The file mtime is the time the entry was last stored or revalidated.
+        """
+        filename = self.filename(key)
+        try:
+            with open(filename, encoding="utf-8") as file_:
+                entry = json.load(file_)
+            entry["stored"] = os.stat(filename).st_mtime
+            return entry
+        except (OSError, ValueError):
+            return None
+
+    def store(self, key: str, entry: dict):
+        """Write an entry atomically"""
+        filename = self.filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        hold = f"{filename}.{os.getpid()}.tmp"
+        with open(hold, "w", encoding="utf-8") as file_:
+            json.dump(entry, file_)
+        os.replace(hold, filename)
+
+    def prune(self):
+        """Delete expired entries, then the oldest while over max_bytes
+
+        Revalidation touches an entry, so only pages nothing asks for any
+        more age out.
+        """
+        self.pruned = time.time()
+        cutoff = self.pruned - max(self.ttl * PRUNE_TTLS, PRUNE_AGE)
+        entries = []
+        for root, _, names in os.walk(os.path.join(self.directory, "api")):
+            for name in names:
+                filename = os.path.join(root, name)
+                try:
+                    stat = os.stat(filename)
+                    if stat.st_mtime < cutoff:
+                        os.remove(filename)
+                    elif not name.endswith(".tmp"):
+                        entries.append((stat.st_mtime, stat.st_size, filename))
+                except OSError:
+                    continue
+        total = sum(i[1] for i in entries)
+        for _, size, filename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(filename)
+                total -= size
+            except OSError:
+                continue
+
+    def fresh(self, entry: dict) -> bool:
+        """True if the entry can be served without revalidating"""
+        return time.time() - entry["stored"] < self.ttl
+
+    async def fetch(
+        self, client, url: str, params: Optional[dict] = None, **kwargs
+    ) -> str:
+        """GET through the cache with a PartyClient, returns the body
+
+        Non-200 responses are returned uncached so callers still see them.
+        """
+        if not self.enabled:
+            return (await client.fetch_text(url, params, **kwargs))[2]
+        if self.pruned is None or time.time() - self.pruned > PRUNE_INTERVAL:
+            await asyncio.to_thread(self.prune)
+        key = self.key(url, params)
+        entry = await asyncio.to_thread(self.load, key)
+        if entry and self.fresh(entry):
+            debug_event("cache hit", url=url, params=params)
+            return entry["body"]
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        status, resp_headers, body = await client.fetch_text(
+            url, params, headers, **kwargs
+        )
+        if status == 304 and entry:
+            os.utime(self.filename(key))
+            return entry["body"]
+        # Challenge pages can come back as 200 html, never cache those
+        if status == 200 and body.lstrip()[:1] in ("[", "{"):
+            await asyncio.to_thread(
+                self.store,
+                key,
+                dict(
+                    url=url,
+                    params=params,
+                    etag=resp_headers.get("etag"),
+                    last_modified=resp_headers.get("last-modified"),
+                    body=body,
+                ),
+            )
+        return body
+
+
+class SizeCache:
+    """Content lengths keyed by data path, kept in {directory}/sizes.json
+
+    Data paths are content hashes, so a size never goes stale and entries
+    have no ttl. Loaded on first use; save merges with whatever other
+    processes wrote in the meantime. Follows the response cache directory
+    and is off when that cache is.
+    """
+
+    def __init__(self):
+        self.sizes: Optional[Dict[str, int]] = None
+        self.dirty = False
+
+    @property
+    def filename(self) -> str:
+        """Location on disk"""
+        return os.path.join(response_cache.directory, "sizes.json")
+
+    def _read(self) -> Dict[str, int]:
+        try:
+            with open(self.filename, encoding="utf-8") as file_:
+                return json.load(file_)
+        except (OSError, ValueError):
+            return {}
+
+    def load(self) -> Dict[str, int]:
+        """Known sizes, read from disk once"""
+        if self.sizes is None:
+            self.sizes = self._read() if response_cache.enabled else {}
+        return self.sizes
+
+    def get(self, path: str) -> Optional[int]:
+        """Cached size for a data path"""
+        return self.load().get(path)
+
+    def put(self, path: str, size: Optional[int]):
+        """Remember a size"""
+        if size is not None and self.load().get(path) != size:
+            self.sizes[path] = size
+            self.dirty = True
+
+    def save(self):
+        """Write new sizes, if any, atomically"""
+        if not self.dirty or not response_cache.enabled:
+            return
+        merged = self._read()
+        merged.update(self.sizes)
+        os.makedirs(response_cache.directory, exist_ok=True)
+        hold = f"{self.filename}.{os.getpid()}.tmp"
+        with open(hold, "w", encoding="utf-8") as file_:
+            json.dump(merged, file_)
+        os.replace(hold, self.filename)
+        self.sizes = merged
+        self.dirty = False
+
+
+response_cache = ResponseCache()
+size_cache = SizeCache()
+
+
+def get_cache() -> ResponseCache:
+    """Fetch the shared response cache"""
+    return response_cache
+
+
+def get_size_cache() -> SizeCache:
+    """Fetch the shared size cache"""
+    return size_cache
+
+
+def configure_cache(
+    ttl: Optional[float] = None, directory: Optional[str] = None
+):
+    """Adjust the shared cache, None leaves a setting unchanged"""
+    if ttl is not None:
+        response_cache.ttl = ttl
+    if directory is not None:
+        response_cache.directory = directory
+    # Spawned shard workers configure themselves from these
+    os.environ["PARTY_CACHE_TTL"] = str(response_cache.ttl)
+    os.environ["PARTY_CACHE_DIR"] = response_cache.directory
+
+
+def configure_worker_cache():
+    """configure_cache for a spawned worker, from its parent's settings"""
+    ttl = os.environ.get("PARTY_CACHE_TTL")
+    configure_cache(
+        ttl=float(ttl) if ttl else None,
+        directory=os.environ.get("PARTY_CACHE_DIR") or None,
+    )
@@ -5,13 +5,16 @@ import asyncio
 
 import os
 import re
-import socket
 import sys
 
-from typing import Counter
+from contextlib import nullcontext
+from datetime import datetime
+from itertools import islice
+from typing import Counter, Optional
 from urllib3.exceptions import ConnectTimeoutError
 
 import aiohttp
+import click
 import simplejson as json
 import typer
 
@@ -19,20 +22,52 @@ from loguru import logger
 from marshmallow_jsonschema import JSONSchema
 from merge_args import merge_args
 from prettytable import PrettyTable
-from tqdm.asyncio import tqdm
 from typing_extensions import Annotated
 from yaspin import yaspin
 
+from .cache import configure_cache, get_size_cache
+from .client import ClientRunner, PartyClient
 from .common import (
-    generate_token,
     StatusEnum,
+    get_etags,
+    set_etags,
     update_csluglify,
     write_etags,
     load_etags,
     format_filenames,
+    parse_size,
 )
-from .posts import AttachmentSchema, Attachment
+from .external import (
+    collect_links,
+    fetch_links,
+    load_fetchers,
+    parse_domain_limits,
+)
+from .extract import extract, load_cached_posts
+from .filters import PostFilter
+from .logs import DEFAULT_LOG, configure_logging
+from .loop import BACKENDS, run_async, set_loop_backend
+from .manifest import (
+    merge_results,
+    parse_shard,
+    read_manifest,
+    select_shard,
+    shard_suffix,
+    write_manifest,
+)
+from .metrics import get_report, reset_report
+from .mirrors import get_endpoint_pool, resolve_site, set_routing, site_family
+from .posts import AttachmentSchema, Attachment, PostSchema
+from .profiling import DEFAULT_OUTPUT, DEFAULT_STALL, phase, start_profiler
+from .progress import human_bytes, render, reset_progress
+from .schedule import SCHEDULES, schedule_files
+from .search import CreatorIndex
+from .ratelimit import set_bandwidth, watch_bandwidth_file
+from .shard import SHARD_KEYS, download_sharded
+from .sizes import head_sizes, summarize_sizes
 from .user import User
+from .verify import set_verify_downloads, verify_paths
+from .watch import Watcher, find_creators
 
 if sys.platform == "win32":
     sys.stdin.reconfigure(encoding="utf-8")
@@ -40,6 +75,37 @@ if sys.platform == "win32":
 
 APP = typer.Typer(no_args_is_help=True)
 
+
+def parse_bandwidth(value: Optional[str]) -> Optional[int]:
+    """Option callback, --bandwidth as bytes per second before any work"""
+    if value is None:
+        return None
+    try:
+        return parse_size(value)
+    except (ValueError, AttributeError) as err:
+        raise typer.BadParameter(
+            f"{value!r} is not a size such as 500K or 10M"
+        ) from err
+
+
+def check_domain_limits(values: list[str]) -> list[str]:
+    """Option callback, reject bad host=N pairs before any work"""
+    try:
+        parse_domain_limits(values or [])
+    except ValueError as err:
+        raise typer.BadParameter(f"{err}") from err
+    return values
+
+
+def check_fetchers(values: list[str]) -> list[str]:
+    """Option callback, import fetcher modules before any work"""
+    try:
+        load_fetchers(values or [])
+    except ImportError as err:
+        raise typer.BadParameter(f"{err}") from err
+    return values
+
+
 # Define Common args and options for commands
 
 service_arg = typer.Argument(
@@ -105,6 +171,66 @@ file_format_option = typer.Option(
     "combining post_id and ordering the files based on appearance in the post "
     "while keeping the original filename and extension"
 )
+jsonl_option = typer.Option(
+    help="Stream NDJSON, one object per line, as posts are paginated"
+)
+date_option = typer.Option(
+    help="Date window filter, e.g. 2023-06-01. Listing stops paginating once "
+    "posts are older than --published-after"
+)
+post_range_option = typer.Option(help="Inclusive numeric post id bound")
+include_option = typer.Option(
+    "-x",
+    "--include-extension",
+    help="Only download files with this extension, repeatable",
+)
+headless_option = typer.Option(
+    help="Skip the progress bar and log a status line every minute instead, "
+    "for cron. Implied when stderr is not a terminal"
+)
+processes_option = typer.Option(
+    "-P",
+    "--processes",
+    help="Shard downloads across this many processes, each with its own "
+    "event loop and connection pool. Workers and bandwidth are split evenly",
+)
+shard_by_option = typer.Option(
+    click_type=click.Choice(SHARD_KEYS),
+    help="How files are split between processes: size or host",
+)
+bandwidth_option = typer.Option(
+    callback=parse_bandwidth,
+    help="Cap total download bandwidth, shared by all workers, e.g. 500K or "
+    "10M (bytes per second). Adjust a running pull by writing a new value "
+    "to {directory}/.bandwidth",
+)
+schedule_option = typer.Option(
+    click_type=click.Choice(SCHEDULES),
+    help="Download order: post (as listed), small (smallest first) or lpt "
+    "(largest first, shortest total time). small and lpt HEAD unknown sizes "
+    "first",
+)
+verify_option = typer.Option(
+    help="Hash each finished download against the sha256 in its path; "
+    "mismatches are removed and reported as ERROR_CHECKSUM"
+)
+links_option = typer.Option(
+    help="Also fetch embedded links, and url named attachments when they are "
+    "excluded, into {directory}/external"
+)
+domain_limit_option = typer.Option(
+    callback=check_domain_limits,
+    help="Concurrent link fetches for one domain, as host=N, repeatable; "
+    "other domains get 2",
+)
+fetcher_option = typer.Option(
+    callback=check_fetchers,
+    help="Module to import that registers extra link fetchers, repeatable",
+)
+metrics_option = typer.Option(
+    help="Also write the run report as a prometheus textfile to this path. "
+    "The json report is always written to {directory}/.report.json"
+)
 
 
 def pull_user(
@@ -125,153 +251,293 @@ def pull_user(
     size_limit: Annotated[int, size_limit_option] = -1,
     sluglify: bool = False,
     full_check: bool = False,
+    metrics_file: Annotated[str, metrics_option] = None,
+    bandwidth: Annotated[str, bandwidth_option] = None,
+    headless: Annotated[bool, headless_option] = False,
+    processes: Annotated[int, processes_option] = 1,
+    shard_by: Annotated[str, shard_by_option] = "size",
+    published_after: Annotated[datetime, date_option] = None,
+    published_before: Annotated[datetime, date_option] = None,
+    added_after: Annotated[datetime, date_option] = None,
+    added_before: Annotated[datetime, date_option] = None,
+    min_post_id: Annotated[int, post_range_option] = None,
+    max_post_id: Annotated[int, post_range_option] = None,
+    include_extensions: Annotated[list[str], include_option] = [],
+    schedule: Annotated[str, schedule_option] = "post",
+    verify: Annotated[bool, verify_option] = False,  # pylint: disable=W0621
+    links: Annotated[bool, links_option] = False,  # pylint: disable=W0621
+    domain_limit: Annotated[list[str], domain_limit_option] = [],
+    fetcher: Annotated[list[str], fetcher_option] = [],
 ):
     logger.debug(f"Excluded Extensions: {exclude_extensions}")
-    if name:
-        user = User(user_id, name, service, site=site)
-    else:
-        try:
-            with yaspin().shark as spin:
-                spin.text = "Pulling user DB"
-                user = User.get_user(site, service, user_id)
-        except ConnectTimeoutError:
-            typer.secho("Connection error occured", fg=typer.colors.BRIGHT_RED)
-            sys.exit(3)
-        except StopIteration:
-            typer.secho("User not found.", fg=typer.colors.BRIGHT_RED)
-            typer.secho(
-                f"You attempted the pull with {service}, "
-                "maybe try a different service or search?",
-                fg=typer.colors.BRIGHT_RED,
-            )
-            sys.exit(3)
-    directory = user.name if not directory else directory
-    user.directory = directory
-    if not os.path.exists(directory):
-        os.mkdir(directory)
-    if os.path.exists(f"{directory}/.etags"):
-        load_etags(directory)
-    if post_id:
-        file_format = "{ref.post_id}_{ref.filename}"
-    elif post_title:
-        file_format = "{ref.post_title}_{ref.filename}"
-    elif ordered_short:
-        file_format = "{ref.post_id}_{ref.index:03}.{ref.extension}"
-    options = dict(
-        exclude_extensions=exclude_extensions,
-        files=files,
-        exclude_external=exclude_external,
-        site=site,
-        directory=directory,
-        ordered_short=ordered_short,
-        file_format=file_format,
-        sluglify=sluglify,
-        size_limit=size_limit,
-    )
+    set_verify_downloads(verify)
+    # Lookup, listing and downloads all share one client
+    with ClientRunner(site) as runner:
+        client = runner.client
+        if name:
+            user = User(user_id, name, service, site=site)
+        else:
+            try:
+                with yaspin().shark as spin:
+                    spin.text = "Pulling user DB"
+                    user = runner.run(User.aget_user(client, service, user_id))
+            except (
+                ConnectTimeoutError,
+                aiohttp.ClientConnectionError,
+                asyncio.TimeoutError,
+            ):
+                typer.secho(
+                    "Connection error occured", fg=typer.colors.BRIGHT_RED
+                )
+                sys.exit(3)
+            except LookupError:
+                typer.secho("User not found.", fg=typer.colors.BRIGHT_RED)
+                typer.secho(
+                    f"You attempted the pull with {service}, "
+                    "maybe try a different service or search?",
+                    fg=typer.colors.BRIGHT_RED,
+                )
+                sys.exit(3)
+        directory = user.name if not directory else directory
+        user.directory = directory
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+        if os.path.exists(f"{directory}/.etags"):
+            load_etags(directory)
+        file_format = resolve_file_format(
+            file_format, post_id, post_title, ordered_short
+        )
+        options = dict(
+            exclude_extensions=exclude_extensions,
+            files=files,
+            exclude_external=exclude_external,
+            site=site,
+            directory=directory,
+            ordered_short=ordered_short,
+            file_format=file_format,
+            sluglify=sluglify,
+            size_limit=size_limit,
+        )
+        post_filter = PostFilter(
+            published_after=published_after,
+            published_before=published_before,
+            added_after=added_after,
+            added_before=added_before,
+            min_post_id=min_post_id,
+            max_post_id=max_post_id,
+            include_extensions=include_extensions,
+            exclude_extensions=exclude_extensions,
+            exclude_external=exclude_external,
+            max_size=size_limit,
+        )
+        # Only the filter options that were set, so older .info files stay tidy
+        options.update(
+            {
+                k: v
+                for k, v in post_filter.for_json().items()
+                if k not in options and k != "max_size" and v not in (None, [])
+            }
+        )
 
-    update_csluglify(sluglify)
-    user.write_info(options)
-    logger.debug(
-        f"Working on: {service} {user.id} {user.name} with {workers} workers"
-    )
-    logger.debug(options)
-    with yaspin(text=f"User found: {user.name}; parsing posts..."):
-        posts = list(
-            user.limit_posts(limit) if limit else user.generate_posts()
+        update_csluglify(sluglify)
+        user.write_info(options)
+        logger.debug(
+            f"Working on: {service} {user.id} {user.name} with {workers} workers"
         )
-        embedded = [embed for p in posts if (embed := p.embed)]
-        files = [f for p in posts for f in p.get_files(files)]
-        if exclude_extensions:
-            files = list(
-                filter(
-                    lambda x: not any(
-                        x["name"].endswith(i) for i in exclude_extensions
-                    ),
+        logger.debug(options)
+        with yaspin(text=f"User found: {user.name}; parsing posts..."):
+            posts = runner.run(user.alimit_posts(client, limit, post_filter))
+            embedded = [embed for p in posts if (embed := p.embed)]
+            files = name_files(
+                posts,
+                files,
+                post_filter,
+                file_format,
+                ordered_short,
+                exclude_external,
+            )
+        if embedded:
+            embed_filename = f"{directory}/.embedded"
+            logger.debug(
+                f"Embedded objects found; saving to {embed_filename}",
+            )
+            with open(
+                f"{directory}/.embedded", "w", encoding="utf-8"
+            ) as embed_file:
+                json.dump(embedded, embed_file)
+        with open(f"{directory}/.posts", "w", encoding="utf-8") as posts_file:
+            json.dump(posts, posts_file, for_json=True)
+        typer.secho(
+            f"Downloading from user: {user.name}", fg=typer.colors.MAGENTA
+        )
+        report = reset_report(
+            workers=workers, files=len(files), processes=processes
+        )
+        if processes > 1:
+            output = download_sharded(
+                site,
+                directory,
+                files,
+                workers,
+                full_check,
+                size_limit,
+                headless,
+                processes,
+                shard_by,
+                bandwidth,
+                schedule,
+            )
+        else:
+            set_bandwidth(bandwidth)
+            output = runner.run(
+                download_async(
+                    site,
+                    directory,
                     files,
+                    workers,
+                    full_check,
+                    size_limit,
+                    headless,
+                    client=client,
+                    schedule=schedule,
                 )
             )
+        try:
+            if links:
+                load_fetchers(fetcher)
+                output += runner.run(
+                    fetch_links(
+                        directory,
+                        collect_links(posts, attachments=exclude_external),
+                        parse_domain_limits(domain_limit),
+                        headless=headless,
+                    )
+                )
+        finally:
+            # Keep what the downloads learned even if the links stage fails
+            write_etags(directory)
+            write_report(directory, metrics_file)
+        count = Counter([f"{i}" for i in output])
+        logger.info(f"Output status: {count}")
+        logger.debug(report.summary()["hosts"])
+
+
+def resolve_file_format(
+    file_format: str,
+    post_id: bool = False,
+    post_title: bool = False,
+    ordered_short: bool = False,
+) -> str:
+    """Apply the file_format shortcut flags"""
+    if post_id:
+        return "{ref.post_id}_{ref.filename}"
+    if post_title:
+        return "{ref.post_title}_{ref.filename}"
+    if ordered_short:
+        return "{ref.post_id}_{ref.index:03}.{ref.extension}"
+    return file_format
+
+
+def name_files(
+    posts,
+    include_files: bool,
+    post_filter: PostFilter,
+    file_format: str,
+    ordered_short: bool = False,
+    exclude_external: bool = True,
+) -> list[Attachment]:
+    """Expand posts into filtered, uniquely named Attachments"""
+    with phase("naming"):
+        files = [
+            f for p in posts for f in p.get_files(include_files, post_filter)
+        ]
         if ordered_short:
             files = format_filenames(
                 files, file_format, ["jpg", "png", "jpeg"]
             )
         else:
             files = format_filenames(files, file_format)
-        if exclude_external:
-            files = [i for i in files if "//" not in i.name]
-        else:
+        if not exclude_external:
             for i in files:
                 if "//" in i.name:
                     i.name = i.name.split("/").pop()
-    if embedded:
-        embed_filename = f"{directory}/.embedded"
-        logger.debug(
-            f"Embedded objects found; saving to {embed_filename}",
-        )
-        with open(
-            f"{directory}/.embedded", "w", encoding="utf-8"
-        ) as embed_file:
-            json.dump(embedded, embed_file)
-    with open(f"{directory}/.posts", "w", encoding="utf-8") as posts_file:
-        json.dump(posts, posts_file, for_json=True)
-    typer.secho(f"Downloading from user: {user.name}", fg=typer.colors.MAGENTA)
-    with tqdm(total=len(files)) as pbar:
-        output = asyncio.run(
-            download_async(
-                pbar, site, directory, files, workers, full_check, size_limit
-            )
-        )
-    write_etags(directory)
-    count = Counter([f"{i}" for i in output])
-    logger.info(f"Output status: {count}")
+    return files
+
+
+def write_report(directory: str, metrics_file: str = None):
+    """Write the current run report as json, and optionally prometheus"""
+    report = get_report()
+    report.meta["endpoints"] = get_endpoint_pool().for_json()
+    report.write_json(f"{directory}/.report.json")
+    if metrics_file:
+        report.write_prometheus(metrics_file)
 
 
 async def download_async(
-    pbar,
     base_url,
     directory,
     files,
     workers: int = 10,
     full_check: bool = False,
     size_limit: int = -1,
+    headless: bool = False,
+    reporter=None,
+    client: PartyClient = None,
+    schedule: str = "post",
 ):
-    """Basic AsyncIO implementation of downloads for files"""
-    timeout = aiohttp.ClientTimeout(sock_read=60, sock_connect=45)
-    conn = aiohttp.TCPConnector(
-        # limit=workers,
-        family=socket.AF_INET,
-        interleave=1,
-        limit_per_host=4,
-        force_close=True,
-    )
+    """Basic AsyncIO implementation of downloads for files
+
+    reporter, if given, is a coroutine function run in place of the progress
+    renderer; shard workers use it to publish their counters to the parent.
+    client is an open PartyClient to reuse; without one a client for
+    base_url is opened for the duration of the call. schedule picks the
+    start order, see schedule.SCHEDULES.
+    """
+    progress = reset_progress(len(files))
 
-    async with aiohttp.ClientSession(
-        base_url,
-        cookies={"__ddg2": generate_token()},
-        connector=conn,
-        # read_bufsize=2**14,
-        timeout=timeout,
+    async with (
+        nullcontext(client) if client else PartyClient(base_url)
     ) as session:
         output = []
+        files = await schedule_files(session, files, schedule, workers)
 
         async def download(file, semaphore):
             filename = f"{directory}/{file.filename}"
             async with semaphore:
-                status = await file.download(
-                    session, filename, 0, full_check, size_limit
-                )
-                await asyncio.to_thread(pbar.update, 1)
+                progress.active += 1
+                try:
+                    status = await file.download(
+                        session, filename, 0, full_check, size_limit
+                    )
+                finally:
+                    progress.active -= 1
+                    progress.files_done += 1
             return status
 
         tasks = []
         semaphore = asyncio.Semaphore(workers)
         logger.debug(workers)
-        async with asyncio.TaskGroup() as tg:
-            for f in files:
-                tasks.append(tg.create_task(download(f, semaphore)))
+        background = [
+            asyncio.create_task(
+                watch_bandwidth_file(f"{directory}/.bandwidth")
+            ),
+            asyncio.create_task(
+                reporter() if reporter else render(headless=headless)
+            ),
+        ]
+        try:
+            with phase("downloads"):
+                async with asyncio.TaskGroup() as tg:
+                    for f in files:
+                        tasks.append(tg.create_task(download(f, semaphore)))
+        finally:
+            for task in background:
+                task.cancel()
+            await asyncio.gather(*background, return_exceptions=True)
 
-        write_etags(directory)
         for stat in [t.result() for t in tasks]:
             output.append(stat)
+        await asyncio.to_thread(get_size_cache().save)
         return output
 
 
@@ -308,24 +574,26 @@ def search(
     interactive: bool = typer.Option(False, "-i", "--interactive"),
     workers: Annotated[int, worker_option] = 32,
     directory: Annotated[str, dir_option] = None,
+    max_results: Annotated[
+        int, typer.Option("-n", "--max-results", help="Rows to show")
+    ] = 50,
+    fuzzy: Annotated[
+        bool,
+        typer.Option(help="Include typo tolerant matches after substrings"),
+    ] = True,
+    refresh: Annotated[
+        bool, typer.Option(help="Rebuild the creator index from the site")
+    ] = False,
 ):  # pylint: disable=W0102, R0913, R0914
-    """Search function"""
-    if site == "kemono":
-        base_url = "https://kemono.su"
-    elif site == "coomer":
-        base_url = "https://coomer.party"
-    elif site == "coomer.su":
-        base_url = "https://coomer.su"
-    else:
+    """Search creators by name; exact, prefix, substring, then fuzzy"""
+    base_url = resolve_site(site)
+    if "://" not in site and site_family(base_url) is None:
         logger.info(f"Invalid site: {site}. Use 'kemono' or 'coomer'.")
         return
-    users = User.generate_users(base_url)
-    check = (
-        (lambda x: x.service == service and search_str in x.name.lower())
-        if service
-        else (lambda x: search_str in x.name.lower())
+    index = CreatorIndex.for_site(base_url, refresh=refresh)
+    results = index.search(
+        search_str, service=service, limit=max_results, fuzzy=fuzzy
     )
-    results = [i for i in users if check(i)]
     table = PrettyTable()
     table.field_names = [
         "Index",
@@ -374,19 +642,61 @@ def custom_parse(
     service: str,
     user_id: str,
     search: str,  # pylint: disable=redefined-outer-name
-    site: str = "https://kemono.party",
+    site: str = "https://kemono.su",
     limit: int = None,
+    name: Annotated[str, name_option] = None,
+    directory: Annotated[
+        str,
+        typer.Option(
+            "-d",
+            "--directory",
+            help="Folder holding a .posts cache from a previous pull or "
+            "dump-posts; defaults to the creator name",
+        ),
+    ] = None,
+    refresh: Annotated[
+        bool, typer.Option(help="Ignore the local .posts cache")
+    ] = False,
+    ignore_case: bool = typer.Option(False, "-i", "--ignore-case"),
+    processes: Annotated[
+        int,
+        typer.Option(
+            "-P",
+            "--processes",
+            help="Processes scanning content; defaults to the cpu count for "
+            "large post sets",
+        ),
+    ] = None,
 ):
-    """Uses provided regex to pull links from the content key on posts"""
+    """Uses provided regex to pull links from the content key on posts
 
-    base_url = site
-    user = User.get_user(base_url, service, user_id)
-    if not os.path.exists(user.name):
-        os.mkdir(user.name)
-    logger.info(f"Downloading {user.name}")
-    posts = user.limit_posts(limit) if limit else user.generate_posts()
-    output = [i for p in posts for i in re.findall(search, p.content)]
-    print(json.dumps(output))
+    Matches stream to stdout as NDJSON, one {"id", "match"} object per line.
+    """
+    flags = re.IGNORECASE if ignore_case else 0
+    try:
+        re.compile(search, flags)
+    except re.error as err:
+        typer.secho(f"Invalid pattern: {err}", fg=typer.colors.BRIGHT_RED)
+        sys.exit(2)
+    if name:
+        user = User(user_id, name, service, site=site)
+    else:
+        user = User.get_user(site, service, user_id)
+    cached = None if refresh else load_cached_posts(directory or user.name)
+    if cached is not None:
+        typer.secho(
+            f"Scanning {len(cached)} cached posts for {user.name}", err=True
+        )
+        cached = cached[:limit] if limit else cached
+        posts = ((p["id"], p["content"]) for p in cached)
+        total = len(cached)
+    else:
+        typer.secho(f"Scanning posts for {user.name}", err=True)
+        source = user.limit_posts(limit) if limit else user.generate_posts()
+        posts = ((p.id, p.content) for p in source if p)
+        total = None
+    for post_id, match in extract(posts, search, flags, processes, total):
+        typer.echo(json.dumps({"id": post_id, "match": match}))
 
 
 @APP.command()
@@ -395,6 +705,12 @@ def update(
     limit: Annotated[int, limit_option] = None,
     workers: Annotated[int, worker_option] = 4,
     full_check: bool = False,
+    metrics_file: Annotated[str, metrics_option] = None,
+    bandwidth: Annotated[str, bandwidth_option] = None,
+    headless: Annotated[bool, headless_option] = False,
+    processes: Annotated[int, processes_option] = 1,
+    schedule: Annotated[str, schedule_option] = "post",
+    verify: Annotated[bool, verify_option] = False,  # pylint: disable=W0621
 ):
     """Update an existing pull from a party site"""
     with open(f"{folder}/.info", encoding="utf-8") as info:
@@ -414,35 +730,518 @@ def update(
         workers=workers,
         limit=limit,
         full_check=full_check,
+        metrics_file=metrics_file,
+        bandwidth=bandwidth,
+        headless=headless,
+        processes=processes,
+        schedule=schedule,
+        verify=verify,
         **settings["options"],
     )
 
 
+@APP.command()
+def plan(
+    service: Annotated[str, service_arg],
+    user_id: Annotated[str, userid_arg],
+    site: str = "https://kemono.su",
+    name: Annotated[str, name_option] = None,
+    directory: Annotated[str, dir_option] = None,
+    manifest: Annotated[
+        str,
+        typer.Option(
+            "-m",
+            "--manifest",
+            help="Manifest path, defaults to {directory}/.manifest.jsonl",
+        ),
+    ] = None,
+    files: bool = True,
+    exclude_external: bool = True,
+    limit: Annotated[int, limit_option] = None,
+    post_id: Annotated[bool, post_id_option] = None,
+    post_title: Annotated[bool, post_title_option] = False,
+    ordered_short: Annotated[bool, ordered_short_option] = False,
+    file_format: Annotated[str, file_format_option] = "{ref.filename}",
+    exclude_extensions: Annotated[list[str], extension_option] = [],
+    include_extensions: Annotated[list[str], include_option] = [],
+    size_limit: Annotated[int, size_limit_option] = -1,
+    sluglify: bool = False,
+    published_after: Annotated[datetime, date_option] = None,
+    published_before: Annotated[datetime, date_option] = None,
+    added_after: Annotated[datetime, date_option] = None,
+    added_before: Annotated[datetime, date_option] = None,
+    min_post_id: Annotated[int, post_range_option] = None,
+    max_post_id: Annotated[int, post_range_option] = None,
+    sizes: Annotated[
+        bool,
+        typer.Option(
+            help="HEAD every file for its size, so shards balance by bytes"
+        ),
+    ] = False,
+    workers: Annotated[int, worker_option] = 16,
+):  # pylint: disable=W0102, R0913, R0914
+    """Resolve, list, filter and name a pull into a manifest for fetch"""
+    post_filter = PostFilter(
+        published_after=published_after,
+        published_before=published_before,
+        added_after=added_after,
+        added_before=added_before,
+        min_post_id=min_post_id,
+        max_post_id=max_post_id,
+        include_extensions=include_extensions,
+        exclude_extensions=exclude_extensions,
+        exclude_external=exclude_external,
+        max_size=size_limit,
+    )
+    file_format = resolve_file_format(
+        file_format, post_id, post_title, ordered_short
+    )
+    update_csluglify(sluglify)
+    with ClientRunner(site) as runner:
+        client = runner.client
+        if name:
+            user = User(user_id, name, service, site=site)
+        else:
+            try:
+                user = runner.run(User.aget_user(client, service, user_id))
+            except LookupError:
+                typer.secho("User not found.", fg=typer.colors.BRIGHT_RED)
+                sys.exit(3)
+        directory = user.name if not directory else directory
+        with yaspin(text=f"User found: {user.name}; parsing posts..."):
+            posts = runner.run(user.alimit_posts(client, limit, post_filter))
+            refs = name_files(
+                posts,
+                files,
+                post_filter,
+                file_format,
+                ordered_short,
+                exclude_external,
+            )
+        if sizes:
+            with yaspin(text=f"Sizing {len(refs)} files..."):
+                runner.run(head_sizes(client, refs, workers))
+    if not os.path.exists(directory):
+        os.mkdir(directory)
+    manifest = manifest or f"{directory}/.manifest.jsonl"
+    header = dict(
+        user=dict(id=user.id, name=user.name, service=user.service),
+        site=site,
+        directory=directory,
+        size_limit=size_limit,
+        filter=post_filter,
+    )
+    write_manifest(manifest, header, refs)
+    known = [r.size for r in refs if r.size is not None]
+    typer.secho(
+        f"Planned {len(refs)} files from {len(posts)} posts"
+        + (f", {human_bytes(sum(known))} known" if known else "")
+        + f" -> {manifest}",
+        fg=typer.colors.MAGENTA,
+    )
+
+
+@APP.command()
+def fetch(
+    manifest: Annotated[str, typer.Argument(help="Manifest written by plan")],
+    shard: Annotated[
+        str,
+        typer.Option(
+            help="Only fetch shard i of N, e.g. 2/4. Results go to per-shard "
+            "files for merge"
+        ),
+    ] = None,
+    directory: Annotated[
+        str,
+        typer.Option(
+            "-d",
+            "--directory",
+            help="Output directory, defaults to the one in the manifest",
+        ),
+    ] = None,
+    workers: Annotated[int, worker_option] = 16,
+    full_check: bool = False,
+    metrics_file: Annotated[str, metrics_option] = None,
+    bandwidth: Annotated[str, bandwidth_option] = None,
+    headless: Annotated[bool, headless_option] = False,
+    schedule: Annotated[str, schedule_option] = "post",
+    verify: Annotated[bool, verify_option] = False,  # pylint: disable=W0621
+):
+    """Download the files in a manifest, or one shard of it"""
+    set_verify_downloads(verify)
+    try:
+        header, refs = read_manifest(manifest)
+        index, count = parse_shard(shard) if shard else (1, 1)
+    except ValueError as err:
+        typer.secho(f"{err}", fg=typer.colors.BRIGHT_RED)
+        sys.exit(2)
+    directory = directory or header["directory"]
+    if not os.path.exists(directory):
+        os.mkdir(directory)
+    if os.path.exists(f"{directory}/.etags"):
+        load_etags(directory)
+    if shard:
+        refs = select_shard(refs, index, count)
+    typer.secho(
+        f"Fetching {len(refs)} files for {header['user']['name']}"
+        + (f", shard {index}/{count}" if shard else ""),
+        fg=typer.colors.MAGENTA,
+    )
+    report = reset_report(workers=workers, files=len(refs), shard=shard)
+    set_bandwidth(bandwidth)
+    output = run_async(
+        download_async(
+            header["site"],
+            directory,
+            refs,
+            workers,
+            full_check,
+            header.get("size_limit", -1),
+            headless,
+            schedule=schedule,
+        )
+    )
+    if shard:
+        # Shards never touch the shared files; merge folds these back in
+        suffix = shard_suffix(index, count)
+        with open(
+            f"{directory}/.etags.{suffix}", "w", encoding="utf-8"
+        ) as file_:
+            json.dump(get_etags(), file_)
+        report.write_json(f"{directory}/.report.{suffix}.json")
+        if metrics_file:
+            report.write_prometheus(metrics_file)
+    else:
+        write_etags(directory)
+        write_report(directory, metrics_file)
+    count = Counter([f"{i}" for i in output])
+    logger.info(f"Output status: {count}")
+
+
+@APP.command()
+def merge(
+    directory: Annotated[
+        str, typer.Argument(help="Directory the shards fetched into")
+    ],
+):
+    """Merge per-shard etags and reports from fetch --shard"""
+    etags, reports = merge_results(directory)
+    typer.secho(
+        f"Merged {etags} etag and {reports} report shards into {directory}",
+        fg=typer.colors.MAGENTA,
+    )
+
+
+def archive_files(directory: str, manifest: str = None):
+    """Rebuild the (site, Attachments) a directory was pulled with
+
+    A manifest from plan is used when there is one; otherwise the names are
+    regenerated from the .posts cache and the .info options, the same way
+    pull_user named them.
+    """
+    manifest = manifest or f"{directory}/.manifest.jsonl"
+    if os.path.exists(manifest):
+        header, refs = read_manifest(manifest)
+        return header["site"], refs
+    with open(f"{directory}/.info", encoding="utf-8") as info:
+        options = json.load(info)["options"]
+    raw = load_cached_posts(directory)
+    if raw is None:
+        raise FileNotFoundError(f"No .posts or manifest in {directory}")
+    posts = PostSchema(many=True).load(raw)
+    update_csluglify(options.get("sluglify", False))
+    file_format = options.get("file_format", "{ref.filename}")
+    post_filter = PostFilter(
+        include_extensions=options.get("include_extensions", []),
+        exclude_extensions=options.get(
+            "exclude_extensions", options.get("ignore_extensions", [])
+        ),
+        exclude_external=options.get("exclude_external", True),
+    )
+    refs = name_files(
+        posts,
+        options.get("files", True),
+        post_filter,
+        file_format,
+        options.get("ordered_short", False),
+        options.get("exclude_external", True),
+    )
+    return options.get("site", options.get("base_url")), refs
+
+
+@APP.command()
+def verify(
+    directory: Annotated[
+        str, typer.Argument(help="Folder from a previous pull or fetch")
+    ],
+    manifest: Annotated[
+        str,
+        typer.Option(
+            "-m",
+            "--manifest",
+            help="Manifest to check against, defaults to "
+            "{directory}/.manifest.jsonl, then the .posts cache",
+        ),
+    ] = None,
+    processes: Annotated[
+        int,
+        typer.Option(
+            "-P", "--processes", help="Hashing processes, default cpu count"
+        ),
+    ] = None,
+    full: Annotated[
+        bool,
+        typer.Option(help="Ignore .verified and hash every file again"),
+    ] = False,
+    refetch: Annotated[
+        bool, typer.Option(help="Download the mismatched files again")
+    ] = True,
+    workers: Annotated[int, worker_option] = 4,
+    headless: Annotated[bool, headless_option] = False,
+):
+    """Hash downloaded files against the sha256 in their data paths
+
+    Runs entirely offline; files that passed before and have the same size
+    and mtime are skipped. Only mismatches go back to the network.
+    """
+    try:
+        site, refs = archive_files(directory, manifest)
+    except FileNotFoundError as err:
+        typer.secho(f"{err}", fg=typer.colors.BRIGHT_RED)
+        sys.exit(2)
+    results = verify_paths(
+        directory,
+        ((f.filename, f.path) for f in refs),
+        processes,
+        use_cache=not full,
+    )
+    logger.info({k: len(v) for k, v in results.items()})
+    bad = set(results["mismatch"])
+    for filename in sorted(bad):
+        typer.secho(f"Mismatch: {filename}", fg=typer.colors.BRIGHT_RED)
+    if not bad or not refetch:
+        sys.exit(1 if bad else 0)
+    requeue = [f for f in refs if f.filename in bad]
+    for ref in requeue:
+        os.remove(f"{directory}/{ref.filename}")
+    # The bad files' etags are already cached, fetch with an empty cache so
+    # they are not skipped as duplicates, then fold the new tags back in
+    if os.path.exists(f"{directory}/.etags"):
+        load_etags(directory)
+    known = list(get_etags())
+    seen = set(known)
+    set_etags([])
+    set_verify_downloads(True)
+    reset_report(workers=workers, files=len(requeue))
+    output = run_async(
+        download_async(site, directory, requeue, workers, headless=headless)
+    )
+    set_etags(known + [t for t in get_etags() if t not in seen])
+    write_etags(directory)
+    verify_paths(directory, ((f.filename, f.path) for f in requeue), 1)
+    count = Counter([f"{i}" for i in output])
+    logger.info(f"Refetch status: {count}")
+    sys.exit(0 if count.get("SUCCESS", 0) == len(requeue) else 1)
+
+
+@APP.command()
+def watch(
+    folders: Annotated[
+        list[str],
+        typer.Argument(
+            help="Creator folders holding a .info, or parents of them"
+        ),
+    ],
+    interval: Annotated[
+        float,
+        typer.Option(
+            help="Seconds between polls per creator; a creator's .info may "
+            'override it with a top level {"watch": {"interval": N}}'
+        ),
+    ] = 3600,
+    jitter: Annotated[
+        float, typer.Option(help="Random fraction each interval may vary by")
+    ] = 0.1,
+    workers: Annotated[int, worker_option] = 8,
+    status_file: Annotated[
+        str,
+        typer.Option(
+            help="Json status with queue depth, throughput and per-creator "
+            "poll state, rewritten every few seconds"
+        ),
+    ] = ".watch.json",
+    full_check: bool = False,
+    bandwidth: Annotated[str, bandwidth_option] = None,
+    bandwidth_file: Annotated[
+        str,
+        typer.Option(
+            help="Control file polled for a new bandwidth limit, e.g. "
+            "`echo 2M > .bandwidth`; empty or 0 removes the cap"
+        ),
+    ] = ".bandwidth",
+    verify: Annotated[bool, verify_option] = False,  # pylint: disable=W0621
+    once: Annotated[
+        bool,
+        typer.Option(help="Poll each creator once, finish downloads, exit"),
+    ] = False,
+):
+    """Keep pulled creators up to date from one long running process"""
+    creators = find_creators(folders, interval)
+    if not creators:
+        typer.secho("No .info files found", fg=typer.colors.BRIGHT_RED)
+        sys.exit(2)
+    typer.secho(
+        f"Watching {len(creators)} creators, status in {status_file}",
+        fg=typer.colors.MAGENTA,
+    )
+    set_bandwidth(bandwidth)
+    set_verify_downloads(verify)
+    watcher = Watcher(
+        creators,
+        workers,
+        jitter,
+        status_file,
+        full_check=full_check,
+        once=once,
+        bandwidth_file=bandwidth_file,
+    )
+    try:
+        run_async(watcher.run())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        logger.info("Stopped watching")
+
+
+@APP.command()
+def links(
+    directory: Annotated[
+        str, typer.Argument(help="Folder from a previous pull")
+    ],
+    domain_limit: Annotated[list[str], domain_limit_option] = [],
+    fetcher: Annotated[list[str], fetcher_option] = [],
+    headless: Annotated[bool, headless_option] = False,
+):
+    """Fetch embedded and external links for an existing pull"""
+    raw = load_cached_posts(directory)
+    if raw is None:
+        typer.secho(f"No .posts in {directory}", fg=typer.colors.BRIGHT_RED)
+        sys.exit(2)
+    options = {}
+    if os.path.exists(f"{directory}/.info"):
+        with open(f"{directory}/.info", encoding="utf-8") as info:
+            options = json.load(info)["options"]
+    found = collect_links(
+        PostSchema(many=True).load(raw),
+        attachments=options.get("exclude_external", True),
+    )
+    typer.secho(f"Fetching {len(found)} links", fg=typer.colors.MAGENTA)
+    if os.path.exists(f"{directory}/.etags"):
+        load_etags(directory)
+    load_fetchers(fetcher)
+    reset_report(files=len(found))
+    try:
+        output = run_async(
+            fetch_links(
+                directory,
+                found,
+                parse_domain_limits(domain_limit),
+                headless=headless,
+            )
+        )
+    finally:
+        write_etags(directory)
+        write_report(directory)
+    count = Counter([f"{i}" for i in output])
+    logger.info(f"Output status: {count}")
+
+
 @APP.command()
 def details(
     service: str,
     user_id: str,
-    site: str = "https://kemono.party",
+    site: str = "https://kemono.su",
     exclude_extensions: list[str] = typer.Option(None, "-i"),
+    limit: Annotated[int, limit_option] = None,
+    sizes: Annotated[
+        bool,
+        typer.Option(
+            help="HEAD every file not in the size cache for a storage "
+            "forecast; --no-sizes only counts"
+        ),
+    ] = True,
+    workers: Annotated[int, worker_option] = 32,
+    as_json: Annotated[
+        bool, typer.Option("--json", help="Print the forecast as json")
+    ] = False,
 ):
-    """Show user details: (post#,attachment#,files#)"""
+    """Show user details: (post#,attachment#,files#) and a storage forecast"""
 
-    with yaspin(text="Pulling user DB") as spin:
-        user = User.get_user(site, service, user_id)
-        spin.ok("✔")
-    with yaspin(text=f"User found: {user.name}; parsing posts...") as spin:
-        posts = user.posts
-        attachments = [a for p in posts for a in p.attachments]
-        files = [p.file for p in posts if p.file]
-        if exclude_extensions:
-            filter_ = lambda x: not any(
-                x.name.endswith(i) for i in exclude_extensions
+    post_filter = PostFilter(exclude_extensions=exclude_extensions or [])
+
+    def spinner(text):
+        # No spinners with --json, stdout carries the document
+        return nullcontext(None) if as_json else yaspin(text=text)
+
+    with ClientRunner(site, limit_per_host=workers) as runner:
+        client = runner.client
+        try:
+            with spinner("Pulling user DB") as spin:
+                user = runner.run(User.aget_user(client, service, user_id))
+                if spin:
+                    spin.ok("✔")
+        except LookupError:
+            typer.secho(
+                "User not found.", fg=typer.colors.BRIGHT_RED, err=True
             )
-            attachments = list(filter(filter_, attachments))
-            files = list(filter(filter_, files))
-        spin.ok("✔")
-    logger.info(
-        dict(posts=len(posts), attachments=len(attachments), files=len(files))
+            sys.exit(3)
+        with spinner(f"User found: {user.name}; parsing posts...") as spin:
+            posts = runner.run(user.alimit_posts(client, limit))
+            refs = [f for p in posts for f in p.get_files(True, post_filter)]
+            attachments = sum(
+                1 for p in posts for _ in p.get_files(False, post_filter)
+            )
+            files = len(refs) - attachments
+            if spin:
+                spin.ok("✔")
+        if sizes:
+            with spinner(f"Sizing {len(refs)} files...") as spin:
+                runner.run(head_sizes(client, refs, workers))
+                if spin:
+                    spin.ok("✔")
+    summary = summarize_sizes(refs)
+    counts = dict(posts=len(posts), attachments=attachments, files=files)
+    if as_json:
+        typer.echo(json.dumps(dict(counts, forecast=summary), for_json=True))
+        return
+    logger.info(counts)
+    table = PrettyTable()
+    table.field_names = ["Extension", "Files", "Size", "Share", "Unknown"]
+    table.align = "r"
+    total = summary["bytes"]
+    for ext, stats in summary["extensions"].items():
+        table.add_row(
+            [
+                ext,
+                stats["files"],
+                human_bytes(stats.get("bytes", 0)),
+                f"{stats.get('bytes', 0) / total:.1%}" if total else "-",
+                stats.get("unknown", 0),
+            ]
+        )
+    print(table)
+    previous = 0
+    for bound, count in summary["histogram"].cumulative():
+        if count > previous:
+            label = bound if bound == "+Inf" else human_bytes(bound)
+            print(f"  <= {label:>10}: {count - previous}")
+        previous = count
+    typer.secho(
+        f"{summary['files']} unique files, {human_bytes(total)}"
+        + (
+            f", {summary['unknown']} of unknown size"
+            if summary["unknown"]
+            else ""
+        ),
+        fg=typer.colors.MAGENTA,
     )
 
 
@@ -450,10 +1249,19 @@ def details(
 def embedded_links(
     service: str,
     user_id: str,
-    site: str = "https://kemono.party",
+    site: str = "https://kemono.su",
+    jsonl: Annotated[bool, jsonl_option] = False,
 ):
-    """Show user details: (post#,attachment#,files#)"""
+    """Show embedded links from a user's posts, as json on stderr or
+    streamed as NDJSON on stdout with --jsonl"""
 
+    if jsonl:
+        # No spinners here, stdout carries the stream
+        user = User.get_user(site, service, user_id)
+        for post in user.generate_posts():
+            if post.embed:
+                typer.echo(json.dumps(post.embed))
+        return
     with yaspin(text="Pulling user DB") as spin:
         user = User.get_user(site, service, user_id)
         spin.ok("✔")
@@ -470,12 +1278,23 @@ def dump_posts(
     site: str = "https://kemono.su",
     limit: Annotated[int, limit_option] = None,
     directory: bool = True,
+    jsonl: Annotated[bool, jsonl_option] = False,
 ):
-    """Write full posts json to {creator}/.posts or .posts if directory=False"""
+    """Write full posts json to {creator}/.posts or .posts if directory=False
+
+    With --jsonl, posts are streamed to .posts.jsonl one line at a time, so
+    memory stays flat and an interrupted dump keeps what it fetched.
+    """
     creator = User(user_id, name, service, site=site)
-    output = f"{name}/.posts" if directory else ".posts_{name}"
+    output = f"{name}/.posts" if directory else f".posts_{name}"
     if directory and not os.path.exists(name):
         os.mkdir(name)
+    if jsonl:
+        with open(f"{output}.jsonl", "w", encoding="utf-8") as file_:
+            for post in islice(creator.generate_posts(), limit):
+                file_.write(json.dumps(post, for_json=True) + "\n")
+                file_.flush()
+        return
     with yaspin(text=f"User found: {creator.name}; parsing posts..."):
         with open(output, "w", encoding="utf-8") as file_:
             json.dump(
@@ -495,22 +1314,79 @@ def dump_schemas():
 
 @APP.callback()
 def configure(
+    ctx: typer.Context,
     verbose: bool = False,
+    loop: Annotated[
+        str,
+        typer.Option(
+            envvar="PARTY_LOOP",
+            click_type=click.Choice(BACKENDS),
+            help="Event loop backend; uvloop must be installed separately "
+            "and falls back to default when missing",
+        ),
+    ] = "default",
+    cache_ttl: Annotated[
+        float,
+        typer.Option(
+            envvar="PARTY_CACHE_TTL",
+            help="Seconds API pages are served from the local cache before "
+            "revalidating; 0 always revalidates, -1 disables the cache",
+        ),
+    ] = 600,
+    cache_dir: Annotated[
+        str,
+        typer.Option(
+            envvar="PARTY_CACHE_DIR",
+            help="Cache location, defaults to ~/.cache/party",
+        ),
+    ] = None,
+    mirrors: Annotated[
+        bool,
+        typer.Option(
+            envvar="PARTY_MIRRORS",
+            help="Route API calls and downloads to the fastest healthy "
+            "domain and data mirror, failing over when one degrades",
+        ),
+    ] = True,
+    debug_log: Annotated[
+        str,
+        typer.Option(
+            envvar="PARTY_DEBUG_LOG",
+            help="Write debug events to this file; otherwise "
+            f"{DEFAULT_LOG} only collects warnings and errors",
+        ),
+    ] = None,
+    diagnose: Annotated[
+        bool,
+        typer.Option(
+            help="Include local variables in logged tracebacks, slow",
+        ),
+    ] = False,
+    profile: Annotated[
+        bool,
+        typer.Option(
+            help="Profile the run: CPU time, per-phase wall time and event "
+            "loop stalls, written to --profile-output .json and .prof",
+        ),
+    ] = False,
+    profile_output: Annotated[
+        str, typer.Option(help="Base name for the profile report")
+    ] = DEFAULT_OUTPUT,
+    profile_stall: Annotated[
+        float,
+        typer.Option(
+            help="Seconds a callback may block the event loop before it is "
+            "reported as a stall"
+        ),
+    ] = DEFAULT_STALL,
 ):
     """A quick cli for downloading from party-chan sites"""
-    logger.remove()
-    if verbose:
-        logger.add(sys.stderr, level="DEBUG")
-    else:
-        logger.add(sys.stdout, level="INFO")
-        logger.add(
-            ".party-debug.log",
-            level="DEBUG",
-            colorize=False,
-            backtrace=True,
-            diagnose=True,
-            enqueue=True,
-        )
+    set_loop_backend(loop)
+    set_routing(mirrors)
+    configure_cache(cache_ttl, cache_dir)
+    configure_logging(verbose, debug_log, diagnose)
+    if profile:
+        ctx.call_on_close(start_profiler(profile_output, profile_stall).stop)
 
 
 if __name__ == "__main__":
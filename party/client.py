@@ -0,0 +1,265 @@
+"""Shared async HTTP client for API listing and file transfers
+
+One PartyClient owns one aiohttp session, so API pages and /data downloads
+share a connection pool, the __ddg2 cookie, one retry/backoff policy and
+one rate-limit cooldown: a 429 on any request pauses every request.
+"""
+import asyncio
+import socket
+import time
+
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Iterator, Optional, Tuple
+
+import aiohttp
+from loguru import logger
+
+from .common import generate_token
+from .logs import debug_event, error_event
+from .loop import loop_factory
+from .mirrors import (
+    api_ok,
+    get_endpoint_pool,
+    get_routing,
+    origin,
+    site_family,
+)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class PartyClient:
+    """Async client bound to one party site
+
+    Attrs:
+        base_url: site root, relative urls such as /data/... join onto it;
+            for known sites this moves to the fastest healthy domain once
+            the requested one fails
+        site: the domain asked for, kept while it works
+        family: every domain of the site, when routing is on
+        retries: attempts after the first for API calls
+        backoff_factor: base of the exponential backoff between attempts
+        cooldown_until: monotonic time before which no request is sent
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        retries: int = 5,
+        backoff_factor: float = 0.2,
+        limit_per_host: int = 4,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.site = self.base_url
+        self.family = site_family(self.base_url) if get_routing() else None
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.limit_per_host = limit_per_host
+        self.cooldown_until = 0.0
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def open(self):
+        """Create the session; must run on the loop that will use it"""
+        if self.session is None:
+            conn = aiohttp.TCPConnector(
+                family=socket.AF_INET,
+                interleave=1,
+                limit_per_host=self.limit_per_host,
+            )
+            self.session = aiohttp.ClientSession(
+                cookies={"__ddg2": generate_token()},
+                connector=conn,
+                timeout=aiohttp.ClientTimeout(sock_read=60, sock_connect=45),
+            )
+            if self.family:
+                await get_endpoint_pool().probe(self.session, self.family)
+                self.reroute()
+        return self
+
+    async def close(self):
+        """Close the session and its pool"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def url(self, url: str) -> str:
+        """Resolve a site relative url, and move urls on any of the site's
+        domains onto the current one"""
+        if url.startswith("/"):
+            return f"{self.base_url}{url}"
+        if self.family and origin(url) in self.family:
+            return f"{self.base_url}{url[len(origin(url)):]}"
+        return url
+
+    def reroute(self):
+        """Switch base_url to the best healthy domain of the site, unless
+        the requested domain is still answering"""
+        if not self.family:
+            return
+        pool = get_endpoint_pool()
+        stats = pool.get(self.site)
+        if stats.healthy and not stats.failures:
+            best = self.site
+        else:
+            best = pool.best(self.family)
+        if best != self.base_url:
+            logger.debug(f"routing {self.base_url} -> {best}")
+            self.base_url = best
+
+    def backoff(self, attempt: int) -> float:
+        """Seconds to wait before retry number attempt"""
+        return self.backoff_factor * 2**attempt
+
+    def note_rate_limited(self, retry_after: Optional[str] = None):
+        """Record a 429 so every request on this client backs off"""
+        try:
+            delay = float(retry_after) if retry_after else 5.0
+        except ValueError:
+            delay = 5.0
+        until = time.monotonic() + delay
+        if until > self.cooldown_until:
+            logger.debug(f"rate limited, pausing requests for {delay}s")
+            self.cooldown_until = until
+
+    async def wait_for_cooldown(self):
+        """Sleep out any active rate-limit cooldown"""
+        delay = self.cooldown_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    @asynccontextmanager
+    async def request(self, method: str, url: str, **kwargs):
+        """Context managed request that honours and feeds the cooldown"""
+        await self.wait_for_cooldown()
+        async with self.session.request(
+            method, self.url(url), **kwargs
+        ) as resp:
+            if resp.status == 429:
+                self.note_rate_limited(resp.headers.get("retry-after"))
+            yield resp
+
+    def head(self, url: str, **kwargs):
+        """HEAD, used as `async with client.head(url) as resp`"""
+        return self.request("HEAD", url, **kwargs)
+
+    def get(self, url: str, **kwargs):
+        """GET, used as `async with client.get(url) as resp`"""
+        return self.request("GET", url, **kwargs)
+
+    async def fetch_text(
+        self,
+        url: str,
+        params: Optional[dict] = None,
+        headers: Optional[dict] = None,
+        timeout: float = 60,
+    ) -> Tuple[int, dict, str]:
+        """GET an API url with retries, returns (status, headers, body)
+
+        Connection errors, timeouts and retryable statuses are retried with
+        exponential backoff; the last response or error is surfaced.
+        """
+        pool = get_endpoint_pool()
+        for attempt in range(self.retries + 1):
+            endpoint = self.base_url
+            started = time.monotonic()
+            try:
+                async with self.get(
+                    url,
+                    params=params,
+                    headers=headers,
+                    timeout=aiohttp.ClientTimeout(total=timeout),
+                ) as resp:
+                    pool.observe(
+                        endpoint,
+                        time.monotonic() - started,
+                        api_ok(resp.status, resp.content_type),
+                    )
+                    body = await resp.text(encoding="utf-8")
+                    debug_event(
+                        "api", status=resp.status, url=lambda: str(resp.url)
+                    )
+                    if resp.status not in RETRY_STATUSES or (
+                        attempt == self.retries
+                    ):
+                        return resp.status, resp.headers, body
+            except (
+                aiohttp.ClientConnectionError,
+                asyncio.TimeoutError,
+            ) as err:
+                pool.observe(endpoint, ok=False)
+                if attempt == self.retries:
+                    raise
+                error_event(
+                    "api failed", endpoint, error=err, url=url, attempt=attempt
+                )
+            self.reroute()
+            await asyncio.sleep(self.backoff(attempt))
+        raise RuntimeError("unreachable")
+
+
+class ClientRunner:
+    """Keep one PartyClient open across several sync steps
+
+    Each run() executes on the same loop, so the session, its pool and the
+    rate-limit state carry over from one step to the next:
+
+        with ClientRunner(site) as runner:
+            user = runner.run(User.aget_user(runner.client, service, name))
+            posts = runner.run(user.alimit_posts(runner.client))
+    """
+
+    def __init__(self, base_url: str, **kwargs):
+        self.runner = asyncio.Runner(loop_factory=loop_factory())
+        self.client = PartyClient(base_url, **kwargs)
+
+    def __enter__(self):
+        self.runner.__enter__()
+        self.run(self.client.open())
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self.run(self.client.close())
+        finally:
+            self.runner.__exit__(*exc)
+
+    def run(self, coro):
+        """Run a coroutine on the runner's loop"""
+        return self.runner.run(coro)
+
+
+def run_with_client(base_url: str, func: Callable):
+    """Run func(client) to completion from sync code on a fresh client"""
+    with ClientRunner(base_url) as runner:
+        return runner.run(func(runner.client))
+
+
+def iterate_with_client(
+    base_url: str, func: Callable[[PartyClient], AsyncIterator]
+) -> Iterator:
+    """Drive the async generator func(client) from sync code
+
+    Items are yielded as the generator produces them, so sync callers keep
+    streaming behaviour. The client lives until the generator is exhausted
+    or closed.
+    """
+    with ClientRunner(base_url) as runner:
+        agen = func(runner.client)
+
+        async def step():
+            return await agen.__anext__()
+
+        try:
+            while True:
+                try:
+                    yield runner.run(step())
+                except StopAsyncIteration:
+                    return
+        finally:
+            runner.run(agen.aclose())
@@ -1,10 +1,14 @@
 import binascii
 import json
 import random
+from contextvars import ContextVar
 from enum import Enum
+from typing import Optional
 
 csluglify = False
 etag_cache = []
+# Per-task override of etag_cache, see scope_etags
+etag_scope: ContextVar[Optional[list]] = ContextVar("etag_scope", default=None)
 
 
 def get_csluglify():
@@ -18,14 +22,36 @@ def update_csluglify(value):
     csluglify = value
 
 
+def _etags():
+    scoped = etag_scope.get()
+    return etag_cache if scoped is None else scoped
+
+
+def scope_etags(values: list):
+    """Route etag lookups in the current task to values instead of the
+    global cache, so one process can serve several output directories"""
+    etag_scope.set(values)
+
+
 def etag_exists(value):
     """Check if an etag exists in the cache"""
-    return value in etag_cache
+    return value in _etags()
+
+
+def get_etags():
+    """Fetch the current etag cache"""
+    return _etags()
+
+
+def set_etags(values):
+    """Replace the etag cache, used to seed sharded worker processes"""
+    global etag_cache
+    etag_cache = list(values)
 
 
 def add_etag(value):
     """Append a single etag to the cache"""
-    etag_cache.append(value)
+    _etags().append(value)
 
 
 def load_etags(directory):
@@ -37,7 +63,7 @@ def load_etags(directory):
 
 def remove_etag(value):
     """Pop a tag off the stack"""
-    etag_cache.remove(value)
+    _etags().remove(value)
 
 
 def write_etags(directory):
@@ -57,6 +83,8 @@ class StatusEnum(Enum):
     ERROR_OSERROR = 6
     DUPLICATE = 7
     TOO_LARGE = 8
+    ERROR_CHECKSUM = 9
+    UNSUPPORTED = 10
 
     def __format__(self, spec):
         return f"{self.name}"
@@ -81,3 +109,14 @@ def format_filenames(files, format_, permitted=None):
         if ref.filename not in new_files:
             new_files[ref.filename] = ref
     return list(new_files.values())
+
+
+def parse_size(value) -> int:
+    """Parse a human size such as 512K, 10M or 1.5G into bytes"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    value = value.strip().upper().rstrip("B").rstrip("I")
+    units = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value or 0))
@@ -0,0 +1,255 @@
+"""Fetch stage for embedded and external links
+
+Posts point outside the party site in two ways: Post.embed, and attachments
+whose name is a full url. Links are handed to the first registered fetcher
+that matches them. Every domain gets its own concurrency limit, so one slow
+file host cannot starve the rest, and results go into the same run report
+and etag cache as regular downloads.
+
+Extra fetchers, e.g. for a file host that needs an API call, subclass
+Fetcher and call register_fetcher; modules holding them can be loaded with
+--fetcher on the command line.
+"""
+import asyncio
+import hashlib
+import importlib
+import os
+import re
+import socket
+
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import unquote, urlparse
+
+import aiohttp
+from aiofile import async_open
+
+from .common import StatusEnum, add_etag, etag_exists
+from .logs import error_event
+from .metrics import DownloadRecord, add_record
+from .progress import get_progress, render, reset_progress
+from .ratelimit import get_limiter
+
+DEFAULT_DOMAIN_LIMIT = 2
+SAFE_NAME = re.compile(r"[^\w.\-]+")
+
+
+@dataclass
+class ExternalLink:
+    """A link found in a post
+
+    Attrs:
+        url: absolute url
+        post_id: post the link came from
+        source: "embed" or "attachment"
+    """
+
+    url: str
+    post_id: str
+    source: str = "embed"
+
+    @property
+    def domain(self) -> str:
+        """Host the link points at"""
+        return urlparse(self.url).netloc.lower()
+
+    @property
+    def filename(self) -> str:
+        """Output name under external/, unique per url"""
+        parsed = urlparse(self.url)
+        base = unquote(parsed.path.rstrip("/").split("/")[-1]) or parsed.netloc
+        digest = hashlib.sha1(self.url.encode()).hexdigest()[:8]
+        return f"{self.post_id}_{digest}_{SAFE_NAME.sub('_', base)[-80:]}"
+
+    def for_json(self):
+        """Simplejson export method"""
+        return dict(url=self.url, post_id=self.post_id, source=self.source)
+
+
+def collect_links(posts, attachments: bool = True) -> List[ExternalLink]:
+    """Links from Post.embed and, optionally, url named attachments
+
+    Duplicate urls are dropped, the first post that used one wins.
+    """
+    output = {}
+    for post in posts:
+        found = []
+        url = (post.embed or {}).get("url")
+        if url:
+            found.append(ExternalLink(url, post.id, "embed"))
+        if attachments:
+            for item in filter(None, post.attachments):
+                name = item.get("name") or ""
+                if "//" in name:
+                    url = name if "://" in name else f"https:{name}"
+                    found.append(ExternalLink(url, post.id, "attachment"))
+        for link in found:
+            output.setdefault(link.url, link)
+    return list(output.values())
+
+
+class Fetcher:
+    """Base fetcher: downloads links that resolve straight to a file
+
+    Subclasses narrow domains and override fetch. concurrency, if set, is
+    the default per-domain limit for the domains the fetcher matches.
+    """
+
+    domains: tuple = ()
+    concurrency: Optional[int] = None
+
+    def matches(self, link: ExternalLink) -> bool:
+        """Whether this fetcher handles link, an empty domains matches all"""
+        if not self.domains:
+            return True
+        return any(
+            link.domain == i or link.domain.endswith(f".{i}")
+            for i in self.domains
+        )
+
+    async def fetch(
+        self,
+        session: aiohttp.ClientSession,
+        link: ExternalLink,
+        filename: str,
+        record: DownloadRecord,
+    ) -> StatusEnum:
+        """GET the link to filename, skipping html landing pages"""
+        progress = get_progress()
+        limiter = get_limiter()
+        record.get_requests += 1
+        async with session.get(link.url, allow_redirects=True) as resp:
+            record.host = resp.url.host
+            if resp.status == 429:
+                return StatusEnum.ERROR_429
+            if resp.status >= 400:
+                error_event(
+                    "external failed",
+                    link.domain,
+                    status=resp.status,
+                    url=link.url,
+                )
+                return StatusEnum.ERROR_OTHER
+            if resp.content_type.startswith("text/html"):
+                return StatusEnum.UNSUPPORTED
+            tag = resp.headers.get("etag")
+            if tag and etag_exists(tag):
+                return StatusEnum.DUPLICATE
+            progress.bytes_total += resp.content_length or 0
+            async with async_open(filename, "wb") as output:
+                async for data in resp.content.iter_chunked(2**16):
+                    await limiter.consume(len(data))
+                    record.mark_first_byte()
+                    record.bytes += len(data)
+                    progress.bytes_done += len(data)
+                    await output.write(data)
+            if tag:
+                add_etag(tag)
+                record.etag = tag
+        return StatusEnum.SUCCESS
+
+
+fetchers: List[Fetcher] = []
+
+
+def register_fetcher(fetcher: Fetcher, first: bool = True):
+    """Add a fetcher; by default it is tried before those already known"""
+    if first:
+        fetchers.insert(0, fetcher)
+    else:
+        fetchers.append(fetcher)
+
+
+def get_fetcher(link: ExternalLink) -> Fetcher:
+    """First registered fetcher that matches link"""
+    return next(f for f in fetchers if f.matches(link))
+
+
+def load_fetchers(modules: Iterable[str]):
+    """Import modules that call register_fetcher"""
+    for name in modules:
+        importlib.import_module(name)
+
+
+register_fetcher(Fetcher())
+
+
+def parse_domain_limits(values: Iterable[str]) -> Dict[str, int]:
+    """Parse host=N pairs, ValueError unless N is a positive integer"""
+    output = {}
+    for value in values:
+        host, _, count = value.partition("=")
+        if not host.strip() or not count.strip().isdigit() or int(count) < 1:
+            raise ValueError(f"Expected host=N with N >= 1, got {value!r}")
+        output[host.strip().lower()] = int(count)
+    return output
+
+
+async def fetch_links(
+    directory: str,
+    links: List[ExternalLink],
+    domain_limits: Optional[Dict[str, int]] = None,
+    default_limit: int = DEFAULT_DOMAIN_LIMIT,
+    headless: bool = False,
+) -> List[StatusEnum]:
+    """Fetch links into {directory}/external with per-domain limits"""
+    os.makedirs(f"{directory}/external", exist_ok=True)
+    domain_limits = domain_limits or {}
+    semaphores: Dict[str, asyncio.Semaphore] = {}
+    progress = reset_progress(len(links))
+
+    def semaphore(link: ExternalLink, fetcher: Fetcher) -> asyncio.Semaphore:
+        if link.domain not in semaphores:
+            limit = domain_limits.get(
+                link.domain, fetcher.concurrency or default_limit
+            )
+            semaphores[link.domain] = asyncio.Semaphore(limit)
+        return semaphores[link.domain]
+
+    async def fetch(session, link):
+        filename = f"{directory}/external/{link.filename}"
+        record = DownloadRecord(filename, link.url)
+        if os.path.exists(filename):
+            status = StatusEnum.EXISTS
+        else:
+            fetcher = get_fetcher(link)
+            async with semaphore(link, fetcher):
+                progress.active += 1
+                try:
+                    status = await fetcher.fetch(
+                        session, link, filename, record
+                    )
+                except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                    error_event(
+                        "external failed", link.domain, error=err, url=link.url
+                    )
+                    status = StatusEnum.ERROR_OTHER
+                except OSError as err:
+                    # Disk errors too, so the pull still saves its etags
+                    error_event(
+                        "external write failed",
+                        link.domain,
+                        error=err,
+                        filename=filename,
+                    )
+                    status = StatusEnum.ERROR_OSERROR
+                finally:
+                    progress.active -= 1
+            if status != StatusEnum.SUCCESS and os.path.exists(filename):
+                os.remove(filename)
+        progress.files_done += 1
+        record.finish(status)
+        add_record(record)
+        return status
+
+    conn = aiohttp.TCPConnector(family=socket.AF_INET, limit=0)
+    async with aiohttp.ClientSession(
+        connector=conn,
+        timeout=aiohttp.ClientTimeout(sock_read=60, sock_connect=45),
+    ) as session:
+        renderer = asyncio.create_task(render(headless=headless))
+        try:
+            return await asyncio.gather(*(fetch(session, l) for l in links))
+        finally:
+            renderer.cancel()
+            await asyncio.gather(renderer, return_exceptions=True)
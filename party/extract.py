@@ -0,0 +1,94 @@
+"""Regex extraction over post content"""
+import os
+import re
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import simplejson as json
+
+# Below this many posts the pool costs more than it saves
+POOL_THRESHOLD = 2000
+CHUNK_SIZE = 250
+
+pattern = None
+
+
+def load_cached_posts(directory: str) -> Optional[List[dict]]:
+    """Return the raw posts saved to {directory}/.posts or streamed to
+    {directory}/.posts.jsonl, whichever was written last, if either is
+    present"""
+    found = [
+        f
+        for f in (f"{directory}/.posts", f"{directory}/.posts.jsonl")
+        if os.path.exists(f)
+    ]
+    if not found:
+        return None
+    filename = max(found, key=os.path.getmtime)
+    with open(filename, encoding="utf-8") as file_:
+        if filename.endswith(".jsonl"):
+            return [json.loads(line) for line in file_ if line.strip()]
+        return json.load(file_)
+
+
+def _init_pool(search: str, flags: int):
+    global pattern
+    pattern = re.compile(search, flags)
+
+
+def scan(
+    chunk: List[Tuple[str, str]], compiled=None
+) -> List[Tuple[str, object]]:
+    """Return (post id, match) pairs for a chunk of (post id, content)"""
+    compiled = compiled or pattern
+    return [
+        (post_id, match)
+        for post_id, content in chunk
+        for match in compiled.findall(content or "")
+    ]
+
+
+def chunked(items: Iterable, size: int) -> Iterator[list]:
+    """Yield lists of up to size items"""
+    items = iter(items)
+    while chunk := list(islice(items, size)):
+        yield chunk
+
+
+def extract(
+    posts: Iterable[Tuple[str, str]],
+    search: str,
+    flags: int = 0,
+    processes: Optional[int] = None,
+    total: Optional[int] = None,
+) -> Iterator[Tuple[str, object]]:
+    """Yield (post id, match) in post order as posts are scanned
+
+    Args:
+        posts: (post id, content) pairs, may be a lazy generator
+        processes: worker processes for large post sets; None picks the cpu
+            count when total is at least POOL_THRESHOLD, 1 scans inline
+        total: number of posts if known, used for the pool decision
+    """
+    if processes is None:
+        large = total is not None and total >= POOL_THRESHOLD
+        processes = os.cpu_count() if large else 1
+    if processes <= 1:
+        compiled = re.compile(search, flags)
+        for chunk in chunked(posts, CHUNK_SIZE):
+            yield from scan(chunk, compiled)
+        return
+    with ProcessPoolExecutor(
+        processes, initializer=_init_pool, initargs=(search, flags)
+    ) as pool:
+        pending = deque()
+        for chunk in chunked(posts, CHUNK_SIZE):
+            pending.append(pool.submit(scan, chunk))
+            # Bound the queue so a lazy post source is not read ahead forever
+            while len(pending) > processes * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
@@ -0,0 +1,126 @@
+"""Declarative post and attachment filters applied during listing"""
+from dataclasses import dataclass, field, fields
+from datetime import datetime
+from typing import List, Optional, Union
+
+from dateutil.parser import parse
+
+DateLike = Optional[Union[datetime, str]]
+
+
+def to_datetime(value: DateLike) -> Optional[datetime]:
+    """Parse a date option or api date into a naive datetime"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        value = parse(value)
+    return value.replace(tzinfo=None)
+
+
+def numeric_id(value) -> Optional[int]:
+    """Post ids are strings in the api, only numeric ones are comparable"""
+    value = str(value)
+    return int(value) if value.isnumeric() else None
+
+
+@dataclass
+class PostFilter:
+    """Filters pushed down into User.generate_posts and Post.get_files
+
+    Attrs:
+        published_after/published_before: window on the post published date;
+            listing stops once posts are older than published_after
+        added_after/added_before: window on the date the post was imported
+        min_post_id/max_post_id: numeric post id range, inclusive
+        include_extensions: if set, only attachments ending with one of these
+        exclude_extensions: attachments ending with any of these are dropped
+        exclude_external: drop attachments whose name is an external url
+        max_size: size cut off in megabytes for attachments with known sizes;
+            unknown sizes are still checked after the download HEAD
+    """
+
+    published_after: DateLike = None
+    published_before: DateLike = None
+    added_after: DateLike = None
+    added_before: DateLike = None
+    min_post_id: Optional[int] = None
+    max_post_id: Optional[int] = None
+    include_extensions: List[str] = field(default_factory=list)
+    exclude_extensions: List[str] = field(default_factory=list)
+    exclude_external: bool = False
+    max_size: int = -1
+
+    def __post_init__(self):
+        for name in (
+            "published_after",
+            "published_before",
+            "added_after",
+            "added_before",
+        ):
+            setattr(self, name, to_datetime(getattr(self, name)))
+        self.include_extensions = list(self.include_extensions or [])
+        self.exclude_extensions = list(self.exclude_extensions or [])
+
+    @staticmethod
+    def _get(post, name):
+        """Posts arrive as Post objects or raw api dicts"""
+        return post[name] if isinstance(post, dict) else getattr(post, name)
+
+    def past_window(self, post) -> bool:
+        """True once the newest-first listing has moved beyond the window"""
+        if self.published_after is None:
+            return False
+        published = to_datetime(self._get(post, "published"))
+        return published is not None and published < self.published_after
+
+    def accepts_post(self, post) -> bool:
+        """Check a post against the date windows and id range"""
+        published = to_datetime(self._get(post, "published"))
+        added = to_datetime(self._get(post, "added"))
+        for value, after, before in (
+            (published, self.published_after, self.published_before),
+            (added, self.added_after, self.added_before),
+        ):
+            if value is None:
+                continue
+            if after is not None and value < after:
+                return False
+            if before is not None and value > before:
+                return False
+        post_id = numeric_id(self._get(post, "id"))
+        if post_id is not None:
+            if self.min_post_id is not None and post_id < self.min_post_id:
+                return False
+            if self.max_post_id is not None and post_id > self.max_post_id:
+                return False
+        return True
+
+    def accepts_file(self, attachment) -> bool:
+        """Check an Attachment against the extension, external and size
+        filters"""
+        name = attachment.name
+        if self.exclude_external and "//" in name:
+            return False
+        if self.include_extensions and not any(
+            name.endswith(i) for i in self.include_extensions
+        ):
+            return False
+        if any(name.endswith(i) for i in self.exclude_extensions):
+            return False
+        if (
+            self.max_size > 0
+            and attachment.size
+            and attachment.size / 1024 / 1024 > self.max_size
+        ):
+            return False
+        return True
+
+    def for_json(self):
+        """Simplejson export method, dates as iso strings"""
+        output = {}
+        for item in fields(self):
+            value = getattr(self, item.name)
+            output[item.name] = (
+                value.isoformat() if isinstance(value, datetime) else value
+            )
+        return output
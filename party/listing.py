@@ -0,0 +1,69 @@
+"""Checkpoints for resumable post listings"""
+import os
+import time
+
+from typing import List, Tuple
+
+import simplejson as json
+from loguru import logger
+
+CHECKPOINT_TTL = 24 * 60 * 60
+
+
+class ListingCheckpoint:
+    """Append-only record of the pages fetched so far for one listing
+
+    Stored as NDJSON in {directory}/.listing: a header naming the listing
+    url, then one {"offset", "posts"} line per page. A page is appended as
+    soon as it parses, so a crash loses at most the page in flight.
+
+    Attrs:
+        filename: checkpoint path
+        url: listing the pages belong to, a checkpoint for another url is
+            ignored
+        ttl: seconds before an old checkpoint is considered stale
+    """
+
+    def __init__(self, directory: str, url: str, ttl: float = CHECKPOINT_TTL):
+        self.filename = f"{directory}/.listing"
+        self.url = url
+        self.ttl = ttl
+
+    def load(self) -> List[Tuple[int, list]]:
+        """Pages from a previous run, stopping at a truncated last line"""
+        if not os.path.exists(self.filename):
+            return []
+        if time.time() - os.path.getmtime(self.filename) > self.ttl:
+            logger.debug(f"Ignoring stale listing checkpoint {self.filename}")
+            return []
+        pages = []
+        with open(self.filename, encoding="utf-8") as file_:
+            try:
+                if json.loads(file_.readline()).get("url") != self.url:
+                    return []
+                for line in file_:
+                    page = json.loads(line)
+                    pages.append((page["offset"], page["posts"]))
+            except (json.JSONDecodeError, KeyError):
+                pass
+        return pages
+
+    def resume(self) -> List[Tuple[int, list]]:
+        """Load usable pages and rewrite the file to hold just those"""
+        pages = self.load()
+        with open(self.filename, "w", encoding="utf-8") as file_:
+            file_.write(json.dumps({"url": self.url}) + "\n")
+            for offset, posts in pages:
+                file_.write(json.dumps({"offset": offset, "posts": posts}))
+                file_.write("\n")
+        return pages
+
+    def append(self, offset: int, posts: list):
+        """Record a freshly fetched page"""
+        with open(self.filename, "a", encoding="utf-8") as file_:
+            file_.write(json.dumps({"offset": offset, "posts": posts}) + "\n")
+
+    def clear(self):
+        """Drop the checkpoint once the listing has finished"""
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
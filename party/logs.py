@@ -0,0 +1,136 @@
+"""Logging setup and cheap structured debug events for hot paths
+
+debug_event returns before touching its fields unless a debug sink is
+installed, and fields given as callables are only evaluated when an event
+is written, so header maps and reprs cost nothing in normal runs. Error
+events are always written, at WARNING to the log file, but rate limited per
+host: a mirror failing thousands of requests logs a few of them plus a
+count of what was dropped. Every file sink is enqueued, so writes happen on
+loguru's writer thread rather than on the event loop.
+"""
+import os
+import sys
+import time
+
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+DEFAULT_LOG = ".party-debug.log"
+# Error events let through per host per window
+ERROR_BURST = 5
+ERROR_WINDOW = 30.0
+
+debug_enabled = False
+
+
+def is_debug() -> bool:
+    """Whether debug events are written anywhere"""
+    return debug_enabled
+
+
+def configure_logging(
+    verbose: bool = False,
+    debug_log: Optional[str] = None,
+    diagnose: bool = False,
+    worker: bool = False,
+):
+    """Install the sinks for this process
+
+    Args:
+        verbose: debug to stderr instead of info to stdout
+        debug_log: write debug events to this file; without it the log
+            file only collects warnings and errors
+        diagnose: include variable values in tracebacks, slow and verbose
+        worker: sharded download worker, keeps stdout free for the bar
+    """
+    global debug_enabled
+    logger.remove()
+    debug_enabled = verbose or bool(debug_log)
+    if verbose:
+        logger.add(sys.stderr, level="DEBUG", enqueue=True)
+    elif worker:
+        logger.add(sys.stderr, level="WARNING", filter=_console)
+    else:
+        # Error events go to the log file, not over the progress bar
+        logger.add(sys.stdout, level="INFO", filter=_console)
+    logger.add(
+        debug_log or DEFAULT_LOG,
+        level="DEBUG" if debug_log else "WARNING",
+        colorize=False,
+        backtrace=diagnose,
+        diagnose=diagnose,
+        enqueue=True,
+    )
+    # Spawned shard workers configure themselves from these
+    os.environ["PARTY_DEBUG_LOG"] = debug_log or ""
+    os.environ["PARTY_DIAGNOSE"] = "1" if diagnose else ""
+
+
+def configure_worker_logging():
+    """configure_logging for a spawned worker, from its parent's settings"""
+    configure_logging(
+        verbose=False,
+        debug_log=os.environ.get("PARTY_DEBUG_LOG") or None,
+        diagnose=bool(os.environ.get("PARTY_DIAGNOSE")),
+        worker=True,
+    )
+
+
+def _console(record) -> bool:
+    return "event" not in record["extra"]
+
+
+def _fields(fields: dict) -> dict:
+    return {k: v() if callable(v) else v for k, v in fields.items()}
+
+
+def debug_event(event: str, **fields):
+    """Write a structured debug event, a no-op unless debug is on"""
+    if not debug_enabled:
+        return
+    logger.opt(depth=1).debug("{} {}", event, _fields(fields))
+
+
+class ErrorSampler:
+    """Per host token window for error events
+
+    Attrs:
+        burst: events let through per host in each window
+        window: window length in seconds
+    """
+
+    def __init__(self, burst: int = ERROR_BURST, window: float = ERROR_WINDOW):
+        self.burst = burst
+        self.window = window
+        # host -> [window start, events let through, events dropped]
+        self.hosts: Dict[str, List[float]] = {}
+
+    def allow(self, host: str) -> Optional[int]:
+        """None to drop the event, else how many were dropped before it"""
+        now = time.monotonic()
+        state = self.hosts.get(host)
+        if state is None or now - state[0] >= self.window:
+            dropped = int(state[2]) if state else 0
+            self.hosts[host] = [now, 1, 0]
+            return dropped
+        if state[1] < self.burst:
+            state[1] += 1
+            return 0
+        state[2] += 1
+        return None
+
+
+error_sampler = ErrorSampler()
+
+
+def error_event(event: str, host: Optional[str] = None, **fields):
+    """Write a failure at WARNING, rate limited per host"""
+    dropped = error_sampler.allow(host or "unknown")
+    if dropped is None:
+        return
+    fields = _fields(fields)
+    fields["host"] = host
+    if dropped:
+        fields["dropped"] = dropped
+    logger.opt(depth=1).bind(event=event).warning("{} {}", event, fields)
@@ -0,0 +1,44 @@
+"""Event loop backend selection for every asyncio entry point
+
+uvloop is optional; install it separately (pip install uvloop) and select it
+with --loop uvloop or PARTY_LOOP=uvloop. Without it the default loop is used.
+"""
+import asyncio
+import os
+
+from loguru import logger
+
+BACKENDS = ("default", "uvloop")
+loop_backend = os.environ.get("PARTY_LOOP", "default")
+
+
+def get_loop_backend() -> str:
+    """Fetch the selected backend name"""
+    return loop_backend
+
+
+def set_loop_backend(value: str):
+    """Select the loop backend, exported so spawned workers inherit it"""
+    global loop_backend
+    if value not in BACKENDS:
+        raise ValueError(f"Unknown loop backend: {value}")
+    loop_backend = value
+    os.environ["PARTY_LOOP"] = value
+
+
+def loop_factory():
+    """Return a loop factory for the selected backend, None for default"""
+    if loop_backend == "uvloop":
+        try:
+            import uvloop  # pylint: disable=import-outside-toplevel
+        except ImportError:
+            logger.warning("uvloop is not installed, using the default loop")
+            return None
+        return uvloop.new_event_loop
+    return None
+
+
+def run_async(coro):
+    """asyncio.run on the selected backend"""
+    with asyncio.Runner(loop_factory=loop_factory()) as runner:
+        return runner.run(coro)
@@ -0,0 +1,121 @@
+"""Download manifests for the two-phase plan/fetch workflow
+
+A manifest is NDJSON: a header line with the user and pull options, then
+one line per file with its final filename. Shards are selected
+deterministically from the manifest alone, so every host running
+`fetch --shard i/N` agrees on the split without coordinating.
+"""
+import glob
+import os
+
+from typing import List, Tuple
+
+import simplejson as json
+
+from .common import get_etags, load_etags, set_etags, write_etags
+from .metrics import DownloadRecord, RunReport
+from .posts import Attachment
+from .shard import partition
+
+MANIFEST_VERSION = 1
+
+
+def write_manifest(filename: str, header: dict, files: List[Attachment]):
+    """Write the header and one line per file"""
+    with open(filename, "w", encoding="utf-8") as file_:
+        file_.write(
+            json.dumps(dict(header, manifest=MANIFEST_VERSION), for_json=True)
+            + "\n"
+        )
+        for ref in files:
+            file_.write(
+                json.dumps(
+                    dict(
+                        name=ref.name,
+                        path=ref.path,
+                        post_id=ref.post_id,
+                        size=ref.size,
+                        filename=ref.filename,
+                    )
+                )
+                + "\n"
+            )
+
+
+def read_manifest(filename: str) -> Tuple[dict, List[Attachment]]:
+    """Return the header and Attachments with their planned filenames"""
+    with open(filename, encoding="utf-8") as file_:
+        header = json.loads(file_.readline())
+        if header.get("manifest") != MANIFEST_VERSION:
+            raise ValueError(f"{filename} is not a party manifest")
+        files = []
+        for line in file_:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            ref = Attachment(
+                data["name"], data["path"], data["post_id"], data["size"]
+            )
+            ref.filename = data["filename"]
+            files.append(ref)
+    return header, files
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parse a 1-based "i/N" shard spec into (i, N)"""
+    try:
+        index, count = (int(i) for i in value.split("/"))
+    except ValueError as err:
+        raise ValueError(f"Shard must look like 1/4, got {value}") from err
+    if not 1 <= index <= count:
+        raise ValueError(f"Shard {index} is outside 1..{count}")
+    return index, count
+
+
+def select_shard(
+    files: List[Attachment], index: int, count: int
+) -> List[Attachment]:
+    """Files for shard index of count, balanced by planned size"""
+    return partition(files, count, "size")[index - 1]
+
+
+def shard_suffix(index: int, count: int) -> str:
+    """File suffix for per-shard results"""
+    return f"shard-{index}-of-{count}"
+
+
+def merge_results(directory: str) -> Tuple[int, int]:
+    """Fold per-shard .etags and reports back into the directory's
+
+    Returns the number of etag and report files merged. Merged shard files
+    are removed, so running it again only picks up new shards.
+    """
+    if os.path.exists(f"{directory}/.etags"):
+        load_etags(directory)
+    etags = list(get_etags())
+    known = set(etags)
+    etag_files = sorted(glob.glob(f"{directory}/.etags.shard-*"))
+    for name in etag_files:
+        with open(name, encoding="utf-8") as file_:
+            for tag in json.load(file_):
+                if tag not in known:
+                    known.add(tag)
+                    etags.append(tag)
+    set_etags(etags)
+    write_etags(directory)
+
+    report_files = sorted(glob.glob(f"{directory}/.report.shard-*.json"))
+    if report_files:
+        report = RunReport()
+        report.meta["shards"] = []
+        for name in report_files:
+            with open(name, encoding="utf-8") as file_:
+                data = json.load(file_)
+            report.meta["shards"].append(data.get("meta", {}))
+            for record in data.get("files", []):
+                report.add(DownloadRecord.from_json(record))
+        report.meta["files"] = len(report.records)
+        report.write_json(f"{directory}/.report.json")
+    for name in etag_files + report_files:
+        os.remove(name)
+    return len(etag_files), len(report_files)
@@ -0,0 +1,287 @@
+"""Per-download instrumentation and machine-readable run reports"""
+import os
+import time
+
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import simplejson as json
+
+from .common import StatusEnum
+
+TTFB_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+THROUGHPUT_BUCKETS = tuple(2**i * 64 * 1024 for i in range(0, 12))
+SIZE_BUCKETS = tuple(2**i * 16 * 1024 for i in range(0, 16, 2))
+
+
+def label_value(value: str) -> str:
+    """Escape a prometheus label value"""
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+@dataclass
+class DownloadRecord:
+    """Timing and request counters for a single Attachment.download call
+
+    Attrs:
+        filename: output file on disk
+        path: path on the server
+        retries: number of times download recursed after a payload error
+        head_requests: HEAD calls issued for this file
+        get_requests: ranged GET calls issued for this file
+        host: final host after redirects, usually the data mirror
+        etag: etag added to the cache for this file, if any
+    """
+
+    filename: str
+    path: str
+    started: float = field(default_factory=time.monotonic)
+    first_byte: Optional[float] = None
+    finished: Optional[float] = None
+    bytes: int = 0
+    retries: int = 0
+    head_requests: int = 0
+    get_requests: int = 0
+    host: Optional[str] = None
+    status: Optional[StatusEnum] = None
+    etag: Optional[str] = None
+
+    def mark_first_byte(self):
+        """Record time to first byte, only the first call counts"""
+        if self.first_byte is None:
+            self.first_byte = time.monotonic()
+
+    def finish(self, status: StatusEnum):
+        """Close out the record with the final download status"""
+        self.finished = time.monotonic()
+        self.status = status
+
+    @property
+    def ttfb(self) -> Optional[float]:
+        """Seconds from start to first received byte"""
+        if self.first_byte is None:
+            return None
+        return self.first_byte - self.started
+
+    @property
+    def elapsed(self) -> float:
+        """Wall time of the download in seconds"""
+        end = self.finished if self.finished is not None else time.monotonic()
+        return end - self.started
+
+    @property
+    def throughput(self) -> Optional[float]:
+        """Bytes per second measured from the first byte onward"""
+        if not self.bytes or self.first_byte is None:
+            return None
+        window = (self.finished or time.monotonic()) - self.first_byte
+        return self.bytes / window if window > 0 else None
+
+    @classmethod
+    def from_json(cls, data: dict) -> "DownloadRecord":
+        """Rebuild a record from for_json output, used to merge reports
+
+        Only relative timings survive, so started is pinned to zero.
+        """
+        ttfb = data.get("ttfb")
+        status = data.get("status")
+        return cls(
+            data["filename"],
+            data["path"],
+            started=0.0,
+            first_byte=ttfb,
+            finished=data.get("elapsed"),
+            bytes=data.get("bytes", 0),
+            retries=data.get("retries", 0),
+            head_requests=data.get("head_requests", 0),
+            get_requests=data.get("get_requests", 0),
+            host=data.get("host"),
+            status=StatusEnum[status]
+            if status in StatusEnum.__members__
+            else None,
+        )
+
+    def for_json(self):
+        """Simplejson export method"""
+        return dict(
+            filename=self.filename,
+            path=self.path,
+            status=f"{self.status}",
+            bytes=self.bytes,
+            ttfb=self.ttfb,
+            elapsed=self.elapsed,
+            throughput=self.throughput,
+            retries=self.retries,
+            head_requests=self.head_requests,
+            get_requests=self.get_requests,
+            host=self.host,
+        )
+
+
+class Histogram:
+    """Cumulative-bucket histogram, rendered the way prometheus expects"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Add a single observation"""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Yield (upper bound, cumulative count) pairs, ending with +Inf"""
+        running = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            running += count
+            yield bound, running
+
+    def for_json(self):
+        """Simplejson export method"""
+        return dict(
+            buckets={f"{b}": c for b, c in self.cumulative()},
+            sum=self.sum,
+            count=self.count,
+        )
+
+
+class RunReport:
+    """Aggregate of DownloadRecords for one run"""
+
+    def __init__(self):
+        self.records: List[DownloadRecord] = []
+        self.meta: Dict[str, object] = {}
+        self.started = time.time()
+
+    def add(self, record: DownloadRecord):
+        """Add a finished record to the report"""
+        self.records.append(record)
+
+    def histograms(self, attr: str, buckets) -> Dict[str, Histogram]:
+        """Build per-host histograms for a DownloadRecord attribute"""
+        output = defaultdict(lambda: Histogram(buckets))
+        for record in self.records:
+            value = getattr(record, attr)
+            if value is not None:
+                output[record.host or "unknown"].observe(value)
+        return dict(output)
+
+    def summary(self) -> dict:
+        """Roll up the records into totals, per-host stats and histograms"""
+        hosts = defaultdict(Counter)
+        for record in self.records:
+            host = hosts[record.host or "unknown"]
+            host["files"] += 1
+            host["bytes"] += record.bytes
+            host["retries"] += record.retries
+            host["head_requests"] += record.head_requests
+            host["get_requests"] += record.get_requests
+        return dict(
+            meta=self.meta,
+            duration=time.time() - self.started,
+            status=Counter(f"{r.status}" for r in self.records),
+            bytes=sum(r.bytes for r in self.records),
+            hosts={k: dict(v) for k, v in hosts.items()},
+            ttfb=self.histograms("ttfb", TTFB_BUCKETS),
+            throughput=self.histograms("throughput", THROUGHPUT_BUCKETS),
+            size=self.histograms("bytes", SIZE_BUCKETS),
+        )
+
+    def write_json(self, filename: str, include_files: bool = True):
+        """Write the summary, plus every record if include_files, as json"""
+        output = self.summary()
+        if include_files:
+            output["files"] = self.records
+        with open(filename, "w", encoding="utf-8") as file_:
+            json.dump(output, file_, for_json=True, indent=2)
+
+    def prometheus(self) -> str:
+        """Render the report in the prometheus text exposition format
+
+        Each family is one block, its TYPE line followed by all samples.
+        """
+        summary = self.summary()
+        hosts = {label_value(k): v for k, v in summary["hosts"].items()}
+        lines = [
+            "# TYPE party_downloads_total counter",
+            *(
+                f'party_downloads_total{{status="{k}"}} {v}'
+                for k, v in summary["status"].items()
+            ),
+        ]
+        for name, key in (
+            ("party_download_bytes_total", "bytes"),
+            ("party_download_retries_total", "retries"),
+        ):
+            lines.append(f"# TYPE {name} counter")
+            for host, stats in hosts.items():
+                lines.append(f'{name}{{host="{host}"}} {stats[key]}')
+        lines.append("# TYPE party_http_requests_total counter")
+        for host, stats in hosts.items():
+            for method in ("head", "get"):
+                lines.append(
+                    f'party_http_requests_total{{host="{host}",'
+                    f'method="{method.upper()}"}} '
+                    f'{stats[f"{method}_requests"]}'
+                )
+        for name, key in (
+            ("party_download_ttfb_seconds", "ttfb"),
+            ("party_download_throughput_bytes_per_second", "throughput"),
+            ("party_download_size_bytes", "size"),
+        ):
+            lines.append(f"# TYPE {name} histogram")
+            for host, hist in summary[key].items():
+                host = label_value(host)
+                for bound, count in hist.cumulative():
+                    lines.append(
+                        f'{name}_bucket{{host="{host}",le="{bound}"}} {count}'
+                    )
+                lines.append(f'{name}_sum{{host="{host}"}} {hist.sum}')
+                lines.append(f'{name}_count{{host="{host}"}} {hist.count}')
+        lines.append("# TYPE party_run_duration_seconds gauge")
+        lines.append(f"party_run_duration_seconds {summary['duration']}")
+        for key, value in summary["meta"].items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f"# TYPE party_run_{key} gauge")
+                lines.append(f"party_run_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, filename: str):
+        """Write a textfile-collector file, atomically so scrapes never see
+        a partial file"""
+        hold = f"{filename}.{os.getpid()}.tmp"
+        with open(hold, "w", encoding="utf-8") as file_:
+            file_.write(self.prometheus())
+        os.replace(hold, filename)
+
+
+run_report = RunReport()
+
+
+def get_report() -> RunReport:
+    """Fetch the report for the current run"""
+    return run_report
+
+
+def reset_report(**meta) -> RunReport:
+    """Start a fresh report for a new run"""
+    global run_report
+    run_report = RunReport()
+    run_report.meta.update(meta)
+    return run_report
+
+
+def add_record(record: DownloadRecord):
+    """Append a finished record to the current run report"""
+    run_report.add(record)
@@ -0,0 +1,238 @@
+"""Latency aware selection between site domains and data mirrors
+
+Every party site answers on several domains, and /data redirects to one of
+a handful of mirror hosts. EndpointPool keeps a rolling latency and error
+rate per endpoint, fed by probes and by real traffic, and picks the
+fastest healthy one. An endpoint that keeps failing is benched for a
+while, so requests fail over to the next best without user action.
+"""
+import asyncio
+import os
+import time
+
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import urlparse
+
+import aiohttp
+from loguru import logger
+
+SITES = {
+    "kemono": (
+        "https://kemono.su",
+        "https://kemono.cr",
+        "https://kemono.party",
+    ),
+    "coomer": (
+        "https://coomer.su",
+        "https://coomer.st",
+        "https://coomer.party",
+    ),
+}
+# Weight of the newest sample in the moving averages
+ALPHA = 0.3
+# Consecutive failures before an endpoint is benched, and for how long
+FAILURES = 3
+BENCH = 60.0
+
+routing = os.environ.get("PARTY_MIRRORS", "1") != "0"
+
+
+def get_routing() -> bool:
+    """Whether requests are routed to the best endpoint"""
+    return routing
+
+
+def set_routing(value: bool):
+    """Toggle routing, exported so spawned workers inherit it"""
+    global routing
+    routing = value
+    os.environ["PARTY_MIRRORS"] = "1" if value else "0"
+
+
+def origin(url: str) -> str:
+    """scheme://host[:port] of a url"""
+    parsed = urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc}"
+
+
+def resolve_site(site: str) -> str:
+    """Expand a site name such as kemono or coomer.su to its url"""
+    if "://" in site:
+        return site.rstrip("/")
+    if site in SITES:
+        return SITES[site][0]
+    return f"https://{site}"
+
+
+def site_family(url: str) -> Optional[tuple]:
+    """All known domains for the site serving url, None if unknown"""
+    base = origin(url)
+    for endpoints in SITES.values():
+        if base in endpoints:
+            return endpoints
+    return None
+
+
+def api_ok(status: int, content_type: str) -> bool:
+    """Whether an API response came from a working endpoint
+
+    Server errors, rate limits and blocks count against the endpoint, and so
+    does any html page, which is a challenge or error page rather than the
+    API. A 404 that is not html is the API saying a creator or post is gone.
+    """
+    if "html" in content_type:
+        return False
+    return status < 400 or status == 404
+
+
+def mirror_family(host: str) -> str:
+    """Group key for data mirrors, n1.kemono.su and n4.kemono.su share one"""
+    parts = host.split(".")
+    return ".".join(parts[1:]) if len(parts) > 2 else host
+
+
+@dataclass
+class EndpointStats:
+    """Rolling health of one endpoint
+
+    Attrs:
+        latency: moving average of seconds to response headers
+        error_rate: moving average of failures, 0 to 1
+        failures: consecutive failures, reset by any success
+        benched_until: monotonic time before which the endpoint is skipped
+    """
+
+    latency: Optional[float] = None
+    error_rate: float = 0.0
+    failures: int = 0
+    requests: int = 0
+    benched_until: float = 0.0
+    last_seen: float = field(default_factory=time.monotonic)
+
+    @property
+    def healthy(self) -> bool:
+        """False while benched"""
+        return time.monotonic() >= self.benched_until
+
+    @property
+    def score(self) -> float:
+        """Lower is better; unmeasured endpoints rank after measured ones"""
+        latency = self.latency if self.latency is not None else 10.0
+        return latency * (1 + 4 * self.error_rate)
+
+    def observe(self, latency: Optional[float], ok: bool):
+        """Fold in one request outcome"""
+        self.requests += 1
+        self.last_seen = time.monotonic()
+        self.error_rate += ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+        if ok:
+            self.failures = 0
+            if latency is not None:
+                self.latency = (
+                    latency
+                    if self.latency is None
+                    else self.latency + ALPHA * (latency - self.latency)
+                )
+            return
+        self.failures += 1
+        if self.failures >= FAILURES:
+            self.benched_until = time.monotonic() + BENCH
+
+    def for_json(self):
+        """Simplejson export method"""
+        return dict(
+            latency=self.latency,
+            error_rate=round(self.error_rate, 4),
+            failures=self.failures,
+            requests=self.requests,
+            healthy=self.healthy,
+        )
+
+
+class EndpointPool:
+    """Stats for every endpoint seen, keyed by origin or mirror host"""
+
+    def __init__(self):
+        self.stats: Dict[str, EndpointStats] = {}
+        self.probed: set = set()
+
+    def get(self, endpoint: str) -> EndpointStats:
+        """Stats for an endpoint, created on first use"""
+        if endpoint not in self.stats:
+            self.stats[endpoint] = EndpointStats()
+        return self.stats[endpoint]
+
+    def observe(
+        self, endpoint: str, latency: Optional[float] = None, ok: bool = True
+    ):
+        """Record a request outcome"""
+        stats = self.get(endpoint)
+        was_healthy = stats.healthy
+        stats.observe(latency, ok)
+        if was_healthy and not stats.healthy:
+            logger.debug(f"{endpoint} degraded, failing over for {BENCH}s")
+
+    def rank(self, endpoints: Iterable[str]) -> List[str]:
+        """Endpoints best first; benched ones last, in case all are"""
+        return sorted(
+            endpoints,
+            key=lambda x: (not self.get(x).healthy, self.get(x).score),
+        )
+
+    def best(self, endpoints: Iterable[str]) -> str:
+        """The fastest healthy endpoint"""
+        return self.rank(endpoints)[0]
+
+    def mirrors(self, host: str) -> List[str]:
+        """Known data mirror hosts in the same family as host"""
+        family = mirror_family(host)
+        return [
+            i
+            for i in self.stats
+            if "://" not in i and mirror_family(i) == family
+        ]
+
+    def route_mirror(self, host: str) -> str:
+        """Best known healthy mirror to use in place of host"""
+        return self.best(self.mirrors(host) or [host])
+
+    async def probe(
+        self,
+        session: aiohttp.ClientSession,
+        endpoints: Iterable[str],
+        timeout: float = 5,
+    ):
+        """Time a HEAD against each endpoint not probed yet, concurrently
+
+        Only a 200 with a json body counts as healthy; a fast 403 challenge
+        page is not an API.
+        """
+
+        async def one(endpoint):
+            started = time.monotonic()
+            try:
+                async with session.head(
+                    f"{endpoint}/api/v1/creators.txt",
+                    timeout=aiohttp.ClientTimeout(total=timeout),
+                ) as resp:
+                    ok = resp.status == 200 and "json" in resp.content_type
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                ok = False
+            self.observe(endpoint, time.monotonic() - started, ok)
+
+        pending = [i for i in endpoints if i not in self.probed]
+        self.probed.update(pending)
+        await asyncio.gather(*(one(i) for i in pending))
+
+    def for_json(self):
+        """Simplejson export method"""
+        return self.stats
+
+
+endpoint_pool = EndpointPool()
+
+
+def get_endpoint_pool() -> EndpointPool:
+    """Fetch the shared endpoint stats"""
+    return endpoint_pool
@@ -2,6 +2,7 @@
 # pylint: disable=invalid-name
 
 import os
+import time
 
 from datetime import datetime
 from dataclasses import dataclass, field
@@ -24,11 +25,10 @@ from aiofile import async_open
 from aiofiles import os as aos
 from caio import thread_aio_asyncio
 from dateutil.parser import parse
-from loguru import logger
-from tqdm.asyncio import tqdm
 from marshmallow import fields, EXCLUDE, Schema
 
 from slugify import slugify
+from .cache import get_size_cache
 from .common import (
     StatusEnum,
     get_csluglify,
@@ -36,6 +36,15 @@ from .common import (
     add_etag,
     remove_etag,
 )
+from .logs import debug_event, error_event
+from .metrics import DownloadRecord, add_record
+from .mirrors import get_endpoint_pool, get_routing
+from .progress import get_progress
+from .ratelimit import get_limiter
+from .verify import check_file, get_verify_downloads
+
+# Chunks are collected up to this size before each disk write
+WRITE_BUFFER = 2**20
 
 
 @dataclass
@@ -45,11 +54,13 @@ class Attachment:
         name: the output file name for the attachment
         path: path on the server
         post_id: Not in the api data, added for post_id prepending
+        size: content length in bytes, when known ahead of the download
     """
 
     name: Optional[str]
     path: Optional[str]
     post_id: Optional[int] = None
+    size: Optional[int] = None
 
     def __post_init__(self):
         # Fix for some filenames containing nested paths
@@ -89,6 +100,11 @@ class Attachment:
         """Manually set filename, for external mod"""
         self._filename = filename
 
+    @property
+    def url(self):
+        """Site relative download url"""
+        return "/data/" + self.path + "?f=" + quote(self.name)
+
     @property
     def index(self):
         """Added for file formatting, exists outside of the schema items"""
@@ -131,12 +147,56 @@ class Attachment:
         retries: int = 0,
         full_check: bool = False,
         cut_off: int = -1,
+        record: Optional[DownloadRecord] = None,
     ):
-        """Async download handler"""
+        """Async download handler
+
+        The outermost call owns the DownloadRecord; retries share it and the
+        record is added to the run report once the final status is known.
+        """
+        owner = record is None
+        if owner:
+            record = DownloadRecord(filename, self.path)
+        record.retries = retries
+        status = await self._download(
+            session, filename, retries, full_check, cut_off, record
+        )
+        if owner and status == StatusEnum.SUCCESS and get_verify_downloads():
+            status = await self.verify(filename, record.etag)
+        if owner:
+            record.finish(status)
+            add_record(record)
+        return status
+
+    async def verify(self, filename: str, tag: Optional[str] = None):
+        """Hash a finished download against the sha256 in its path
+
+        A mismatch removes the file and its etag, so the next run fetches it
+        again instead of calling it a duplicate.
+        """
+        if await asyncio.to_thread(check_file, filename, self.path) is False:
+            debug_event("checksum mismatch", filename=filename)
+            await aos.remove(filename)
+            if tag and etag_exists(tag):
+                await asyncio.to_thread(remove_etag, tag)
+            return StatusEnum.ERROR_CHECKSUM
+        return StatusEnum.SUCCESS
+
+    async def _download(
+        self,
+        session,
+        filename: str,
+        retries: int,
+        full_check: bool,
+        cut_off: int,
+        record: DownloadRecord,
+    ):
+        """Single download attempt, see download"""
+        progress = get_progress()
         status = StatusEnum.SUCCESS
         headers = {}
         start = 0
-        url = "/data/" + self.path + "?f=" + quote(self.name)
+        url = self.url
         exists = await aos.path.exists(filename)
         if exists:
             if not full_check:
@@ -148,8 +208,12 @@ class Attachment:
             "Keep-Alive": "timeout=10, max=600",
         }
         total = 0
+        pool = get_endpoint_pool()
+        direct = None
         try:
+            record.head_requests += 1
             async with session.head(url, allow_redirects=True) as head:
+                record.host = head.url.host
                 size_in_mb = (
                     (int(head.headers["content-length"]) / 1024 / 1024)
                     if "content-length" in head.headers
@@ -160,9 +224,13 @@ class Attachment:
                 try:
                     tag = head.headers["etag"]
                 except:
-                    logger.debug(head.status)
-                    logger.debug(url)
-                    logger.debug(head.headers)
+                    error_event(
+                        "head without etag",
+                        head.url.host,
+                        status=head.status,
+                        url=url,
+                        headers=lambda: dict(head.headers),
+                    )
                     return StatusEnum.ERROR_OTHER
                 if etag_exists(tag) and not exists:
                     return StatusEnum.DUPLICATE
@@ -173,20 +241,25 @@ class Attachment:
                 ):
                     return StatusEnum.TOO_LARGE
                 await asyncio.to_thread(add_etag, tag)
+                record.etag = tag
                 total = int(head.headers["content-length"])
+                get_size_cache().put(self.path, total)
+                # Go straight to the fastest healthy mirror from here on
+                direct = head.url
+                pool.get(direct.host)
+                if get_routing():
+                    url = str(direct.with_host(pool.route_mirror(direct.host)))
+                if retries == 0:
+                    progress.bytes_total += max(total - start, 0)
         except aiohttp.client_exceptions.TooManyRedirects as err:
-            logger.debug(
-                {"error": err, "filename": filename, "url": self.path}
-            )
+            error_event("redirect loop", record.host, error=err, url=self.path)
             status = StatusEnum.ERROR_OTHER
         except (
             ConnectTimeoutError,
             ServerTimeoutError,
             ClientConnectorError,
         ) as err:
-            logger.debug(
-                {"error": err, "filename": filename, "url": self.path}
-            )
+            error_event("head failed", record.host, error=err, url=self.path)
             if "tag" in locals():
                 await asyncio.to_thread(remove_etag, tag)
 
@@ -197,39 +270,55 @@ class Attachment:
                 offset = 2**10 * 2**10 * 100 * count
                 offset = total if offset >= total else offset
                 headers["Range"] = f"bytes={tdata}-{offset}"
+                record.get_requests += 1
+                started = time.monotonic()
                 async with session.get(url, headers=headers) as resp:
+                    record.host = resp.url.host
+                    # A routed mirror that lacks the file counts against it,
+                    # so the pool stops picking it for this family
+                    missed = (
+                        resp.status == 404
+                        and direct is not None
+                        and url != str(direct)
+                    )
+                    pool.observe(
+                        resp.url.host,
+                        time.monotonic() - started,
+                        resp.status < 500 and not missed,
+                    )
+                    if missed:
+                        url = str(direct)
+                        continue
                     if 199 < resp.status < 300:
                         # async with aiofiles.open(filename, "ab") as output:
                         async with async_open(filename, "ab") as output:
-                            with tqdm(
-                                initial=tdata,
-                                desc=filename,
-                                total=total,
-                                unit="b",
-                                unit_divisor=1024,
-                                unit_scale=True,
-                                leave=False,
-                            ) as fbar:
-                                async for data in resp.content.iter_any():
-                                    await output.write(data)
-                                    await output.flush()
-                                    await asyncio.to_thread(
-                                        fbar.update, len(data)
-                                    )
-                                    tdata += len(data)
+                            limiter = get_limiter()
+                            buffer = bytearray()
+                            async for data in resp.content.iter_any():
+                                await limiter.consume(len(data))
+                                record.mark_first_byte()
+                                record.bytes += len(data)
+                                progress.bytes_done += len(data)
+                                tdata += len(data)
+                                buffer += data
+                                if len(buffer) >= WRITE_BUFFER:
+                                    await output.write(bytes(buffer))
+                                    buffer.clear()
+                            if buffer:
+                                await output.write(bytes(buffer))
                     elif resp.status == 416:
                         status = StatusEnum.EXISTS
                     elif resp.status == 429:
                         status = StatusEnum.ERROR_429
                         await asyncio.to_thread(remove_etag, tag)
                     else:
-                        logger.debug(
-                            {
-                                "status": resp.status,
-                                "filename": filename,
-                                "url": resp.url,
-                                "headers": resp.headers,
-                            }
+                        error_event(
+                            "get failed",
+                            resp.url.host,
+                            status=resp.status,
+                            filename=filename,
+                            url=lambda: str(resp.url),
+                            headers=lambda: dict(resp.headers),
                         )
                         await asyncio.to_thread(remove_etag, tag)
                         status = StatusEnum.ERROR_OTHER
@@ -249,39 +338,44 @@ class Attachment:
             ServerTimeoutError,
             ClientConnectorError,
         ) as err:
-            logger.debug(
-                {
-                    "error": err,
-                    "filename": filename,
-                    "url": self.path,
-                }
+            error_event(
+                "transfer failed",
+                record.host,
+                error=err,
+                filename=filename,
+                retries=retries,
             )
+            if record.host:
+                pool.observe(record.host, ok=False)
             if retries < 8:
                 if "tag" in locals():
                     await asyncio.to_thread(remove_etag, tag)
                 status = await self.download(
-                    session, filename, retries + 1, full_check=True
+                    session,
+                    filename,
+                    retries + 1,
+                    full_check=True,
+                    record=record,
                 )
             else:
                 await aos.remove(filename)
                 status = StatusEnum.ERROR_OTHER
         except OSError as err:
-            logger.debug(
-                {
-                    "error": err,
-                    "filename": filename,
-                    "url": self.path,
-                }
+            error_event(
+                "write failed",
+                record.host,
+                error=err,
+                filename=filename,
+                attachment=lambda: repr(self),
             )
-            logger.debug(self)
             status = StatusEnum.ERROR_OSERROR
         except Exception as err:
-            logger.debug(
-                {
-                    "error": err,
-                    "filename": filename,
-                    "url": self.path,
-                }
+            error_event(
+                "download failed",
+                record.host,
+                error=err,
+                filename=filename,
+                url=self.path,
             )
         return status
 
@@ -326,10 +420,14 @@ class Post:
         metadata=desert.metadata(field=fields.Nested(AttachmentSchema))
     )
 
-    def get_files(self, include_files: bool = False) -> Attachment:
+    def get_files(
+        self, include_files: bool = False, filter_=None
+    ) -> Attachment:
         """Quick chain file generator
         Attrs:
             include_files: add self.file to output
+            filter_: PostFilter; rejected attachments are skipped, indexes
+                still count them so ordered names stay stable
 
         Yields:
             Attachment
@@ -340,10 +438,13 @@ class Post:
         for index, post_data in enumerate(filter(None, collection)):
             if "name" in post_data:
                 post = Attachment(**post_data)
+                if post.size is None:
+                    post.size = get_size_cache().get(post.path)
                 post.post_id = self.id
                 post.post_title = self.title
                 post.index = index
-                yield post
+                if filter_ is None or filter_.accepts_file(post):
+                    yield post
 
     def for_json(self):
         """Simplejson export method"""
@@ -0,0 +1,174 @@
+"""Opt-in profiling for a whole run
+
+--profile wraps the command in cProfile, times the named phases of a pull
+(creator lookup, post listing, filename formatting, downloads) and times
+every event loop callback, reporting each one that holds the loop longer
+than the stall threshold along with the task and line it was running. On
+exit the report is written as json next to a pstats dump that snakeviz or
+pstats can open.
+
+Callbacks are timed by wrapping asyncio's Handle._run, the same spot
+asyncio debug mode measures, without debug mode's per-task traceback
+capture that would slow the run being measured. uvloop's handles are
+compiled, so stalls are only seen on the default loop. Sharded download
+workers run in their own processes and are not profiled; their time shows
+up as the downloads phase of the parent.
+"""
+import asyncio
+import cProfile
+import io
+import pstats
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Optional
+
+import simplejson as json
+from loguru import logger
+
+from .loop import get_loop_backend
+
+DEFAULT_OUTPUT = ".party-profile"
+DEFAULT_STALL = 0.1
+# Stalls and functions kept in the report, worst first
+TOP = 50
+
+
+def describe_callback(handle: asyncio.Handle) -> str:
+    """Name what a handle ran: the task and where it stopped, or the call"""
+    # pylint: disable=protected-access
+    task = getattr(handle._callback, "__self__", None)
+    if isinstance(task, asyncio.Task):
+        coro = task.get_coro()
+        name = f"{task.get_name()} {getattr(coro, '__qualname__', coro)}"
+        frame = getattr(coro, "cr_frame", None)
+        if frame is not None:
+            name += f" at {frame.f_code.co_filename}:{frame.f_lineno}"
+        return name
+    return repr(handle)
+
+
+class Profiler:
+    """CPU profile, phase wall times and loop stalls for one run
+
+    Attrs:
+        output: report base name, .json and .prof are appended
+        stall: seconds a callback may hold the loop before it is reported
+        phases: phase name to [total seconds, times entered]
+        stalls: slow callbacks in the order they happened
+    """
+
+    def __init__(
+        self, output: str = DEFAULT_OUTPUT, stall: float = DEFAULT_STALL
+    ):
+        self.output = output
+        self.stall = stall
+        self.phases: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0])
+        self.stalls: List[dict] = []
+        self.profile = cProfile.Profile()
+        self.started = time.perf_counter()
+        self.handle_run = asyncio.Handle._run  # pylint: disable=W0212
+
+    def start(self):
+        """Begin profiling and timing loop callbacks"""
+        if get_loop_backend() != "default":
+            logger.warning("Loop stalls are only detected on the default loop")
+        run = self.handle_run
+        profiler = self
+
+        def timed(handle):
+            started = time.perf_counter()
+            run(handle)
+            took = time.perf_counter() - started
+            if took >= profiler.stall:
+                profiler.stalls.append(
+                    dict(
+                        at=round(started - profiler.started, 3),
+                        seconds=round(took, 4),
+                        callback=describe_callback(handle),
+                    )
+                )
+
+        asyncio.Handle._run = timed  # pylint: disable=W0212
+        self.started = time.perf_counter()
+        self.profile.enable()
+
+    @contextmanager
+    def phase(self, name: str):
+        """Add the wall time of the block to a phase"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name][0] += time.perf_counter() - started
+            self.phases[name][1] += 1
+
+    def functions(self, stats: pstats.Stats) -> List[dict]:
+        """Top functions by cumulative time"""
+        rows = sorted(
+            stats.stats.items(),  # pylint: disable=no-member
+            key=lambda x: x[1][3],
+            reverse=True,
+        )
+        return [
+            dict(
+                function=f"{path}:{line}({name})",
+                calls=calls,
+                tottime=round(tottime, 4),
+                cumtime=round(cumtime, 4),
+            )
+            for (path, line, name), (_, calls, tottime, cumtime, _) in rows[
+                :TOP
+            ]
+        ]
+
+    def stop(self):
+        """Stop profiling and write {output}.json and {output}.prof"""
+        self.profile.disable()
+        asyncio.Handle._run = self.handle_run  # pylint: disable=W0212
+        wall = time.perf_counter() - self.started
+        self.profile.dump_stats(f"{self.output}.prof")
+        stats = pstats.Stats(self.profile, stream=io.StringIO())
+        report = dict(
+            wall=round(wall, 3),
+            cpu=round(stats.total_tt, 3),  # pylint: disable=no-member
+            phases={
+                k: dict(seconds=round(v[0], 3), count=v[1])
+                for k, v in self.phases.items()
+            },
+            stall_threshold=self.stall,
+            stall_count=len(self.stalls),
+            stall_seconds=round(sum(i["seconds"] for i in self.stalls), 3),
+            stalls=sorted(self.stalls, key=lambda x: -x["seconds"])[:TOP],
+            functions=self.functions(stats),
+        )
+        with open(f"{self.output}.json", "w", encoding="utf-8") as file_:
+            json.dump(report, file_, indent=2)
+        logger.info(
+            f"Profile: {wall:.1f}s wall, {len(self.stalls)} loop stalls over "
+            f"{self.stall}s, written to {self.output}.json"
+        )
+
+
+profiler: Optional[Profiler] = None
+
+
+def get_profiler() -> Optional[Profiler]:
+    """Fetch the active profiler, None when profiling is off"""
+    return profiler
+
+
+def start_profiler(
+    output: str = DEFAULT_OUTPUT, stall: float = DEFAULT_STALL
+) -> Profiler:
+    """Create and start the run's profiler"""
+    global profiler
+    profiler = Profiler(output, stall)
+    profiler.start()
+    return profiler
+
+
+def phase(name: str):
+    """Profiler.phase, or a no-op when profiling is off"""
+    return profiler.phase(name) if profiler else nullcontext()
@@ -0,0 +1,103 @@
+"""Aggregated progress reporting for a download run"""
+import asyncio
+import sys
+import time
+
+from dataclasses import dataclass, field
+
+from loguru import logger
+from tqdm import tqdm
+
+
+def human_bytes(value: float) -> str:
+    """Render a byte count with a binary suffix"""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(value) < 1024:
+            return f"{value:.1f}{unit}"
+        value /= 1024
+    return f"{value:.1f}TiB"
+
+
+@dataclass
+class Progress:
+    """Plain counters for the current run
+
+    Counters are only touched from the event loop thread, so downloads bump
+    them directly with no locks or thread hops; the renderer samples them on
+    a fixed interval.
+    """
+
+    files_total: int = 0
+    files_done: int = 0
+    bytes_total: int = 0
+    bytes_done: int = 0
+    active: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    @property
+    def rate(self) -> float:
+        """Average bytes per second since the run started"""
+        elapsed = time.monotonic() - self.started
+        return self.bytes_done / elapsed if elapsed > 0 else 0.0
+
+    def line(self) -> str:
+        """Single line status, used for headless output"""
+        return (
+            f"{self.files_done}/{self.files_total} files, "
+            f"{human_bytes(self.bytes_done)}/{human_bytes(self.bytes_total)}, "
+            f"{human_bytes(self.rate)}/s, {self.active} active"
+        )
+
+
+progress = Progress()
+
+
+def get_progress() -> Progress:
+    """Fetch the progress counters for the current run"""
+    return progress
+
+
+def reset_progress(files_total: int = 0) -> Progress:
+    """Start fresh counters for a new run"""
+    global progress
+    progress = Progress(files_total=files_total)
+    return progress
+
+
+async def render(
+    interval: float = 0.5,
+    headless: bool = False,
+    headless_interval: float = 60,
+):
+    """Draw one aggregated bar until cancelled
+
+    Args:
+        interval: seconds between bar refreshes
+        headless: log a status line every headless_interval instead of
+            drawing a bar, also used when stderr is not a terminal
+    """
+    if headless or not sys.stderr.isatty():
+        try:
+            while True:
+                await asyncio.sleep(headless_interval)
+                logger.info(progress.line())
+        finally:
+            logger.info(progress.line())
+    with tqdm(total=progress.files_total, unit="file", leave=True) as bar:
+        try:
+            while True:
+                _draw(bar)
+                await asyncio.sleep(interval)
+        finally:
+            _draw(bar)
+
+
+def _draw(bar):
+    bar.total = progress.files_total
+    bar.n = progress.files_done
+    bar.set_postfix_str(
+        f"{human_bytes(progress.bytes_done)} "
+        f"@ {human_bytes(progress.rate)}/s, {progress.active} active",
+        refresh=False,
+    )
+    bar.refresh()
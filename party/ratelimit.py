@@ -0,0 +1,114 @@
+"""Process wide bandwidth limiting for downloads"""
+import asyncio
+import os
+import time
+
+from typing import Optional
+
+from loguru import logger
+
+from .common import parse_size
+
+
+class TokenBucket:
+    """Async token bucket measured in bytes per second
+
+    Every consumer waits on the same FIFO lock, so concurrent downloads take
+    turns draining the bucket chunk by chunk and share the rate fairly.
+    A rate of 0 disables limiting entirely.
+    """
+
+    def __init__(self, rate: float = 0, burst: Optional[float] = None):
+        self.rate = 0.0
+        self.burst = burst
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self._lock = None
+        self._loop = None
+        self.set_rate(rate)
+
+    @property
+    def capacity(self) -> float:
+        """Bucket size, a quarter second of traffic unless set explicitly"""
+        return self.burst if self.burst else self.rate / 4
+
+    def set_rate(self, rate: float):
+        """Change the rate in place; in-flight downloads pick it up on their
+        next chunk"""
+        self._refill()
+        self.rate = float(rate)
+        self.tokens = min(self.tokens, self.capacity)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+        self.updated = now
+
+    def _get_lock(self) -> asyncio.Lock:
+        """Locks are bound to a loop; rebuild when a new asyncio.run starts"""
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._loop is not loop:
+            self._lock = asyncio.Lock()
+            self._loop = loop
+        return self._lock
+
+    async def consume(self, size: int):
+        """Wait until size bytes may pass"""
+        if self.rate <= 0:
+            return
+        async with self._get_lock():
+            self._refill()
+            self.tokens -= size
+            if self.tokens < 0 and self.rate > 0:
+                await asyncio.sleep(-self.tokens / self.rate)
+                self._refill()
+
+
+limiter = TokenBucket()
+shares = 1
+
+
+def get_limiter() -> TokenBucket:
+    """Fetch the process wide limiter"""
+    return limiter
+
+
+def set_shares(value: int):
+    """Split every limit evenly across this many sharded processes"""
+    global shares
+    shares = max(int(value), 1)
+
+
+def set_bandwidth(value):
+    """Set the process wide limit from bytes or a size string, 0 for none"""
+    limiter.set_rate(parse_size(value) / shares if value else 0)
+
+
+async def watch_bandwidth_file(filename: str, interval: float = 5):
+    """Poll a control file and apply its contents as the new limit
+
+    Lets a long pull be throttled without a restart, e.g.
+    `echo 2M > {directory}/.bandwidth`; an empty file or 0 removes the cap.
+    A file left over from an earlier run is ignored until it changes.
+    """
+    try:
+        mtime = os.stat(filename).st_mtime
+    except FileNotFoundError:
+        mtime = None
+    while True:
+        try:
+            stat = os.stat(filename)
+            if stat.st_mtime != mtime:
+                mtime = stat.st_mtime
+                with open(filename, encoding="utf-8") as file_:
+                    value = file_.read().strip()
+                set_bandwidth(value)
+                logger.info(f"Bandwidth limit set to {value or 'unlimited'}")
+        except FileNotFoundError:
+            mtime = None
+        except ValueError as err:
+            logger.warning(f"Invalid bandwidth in {filename}: {err}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,71 @@
+"""Size-aware ordering of the files in a download run
+
+download_async starts files in the order it is given them, so ordering is
+the whole scheduler:
+
+    post: post order, as listed
+    small: smallest first, for fast visible progress
+    lpt: longest processing time first, big transfers start early and the
+        small files fill in around them, which keeps the tail short
+
+Files of unknown size always go last.
+"""
+from collections import defaultdict, deque
+from typing import List
+
+from .posts import Attachment
+from .shard import host_key
+from .sizes import head_sizes
+
+SCHEDULES = ("post", "small", "lpt")
+BIG_FILE = 64 * 2**20
+
+
+def spread_hosts(
+    files: List[Attachment], big: int = BIG_FILE
+) -> List[Attachment]:
+    """Interleave big files round robin across host keys
+
+    The data mirror is only known after the redirect, so this uses the hash
+    prefix the mirrors are laid out by, see shard.host_key. Small files keep
+    their place; big files are re-dealt into the slots big files held.
+    """
+    groups = defaultdict(deque)
+    slots = []
+    for index, file in enumerate(files):
+        if (file.size or 0) >= big:
+            groups[host_key(file)].append(file)
+            slots.append(index)
+    output = list(files)
+    queues = deque(groups.values())
+    for index in slots:
+        queue = queues.popleft()
+        output[index] = queue.popleft()
+        if queue:
+            queues.append(queue)
+    return output
+
+
+def order_files(
+    files: List[Attachment], schedule: str = "post", big: int = BIG_FILE
+) -> List[Attachment]:
+    """Return files in the order schedule wants them started"""
+    if schedule == "post":
+        return list(files)
+    if schedule not in SCHEDULES:
+        raise ValueError(
+            f"Unknown schedule {schedule}, use one of {SCHEDULES}"
+        )
+    known = [f for f in files if f.size is not None]
+    unknown = [f for f in files if f.size is None]
+    known.sort(key=lambda x: x.size, reverse=schedule == "lpt")
+    return spread_hosts(known, big) + unknown
+
+
+async def schedule_files(
+    client, files: List[Attachment], schedule: str = "post", workers: int = 16
+) -> List[Attachment]:
+    """HEAD any unknown sizes the schedule needs, then order the files"""
+    if schedule != "post":
+        await head_sizes(client, files, workers)
+    return order_files(files, schedule)
@@ -0,0 +1,301 @@
+"""Trigram search index over a site's creators
+
+The index is persisted next to the creators cache and rebuilt only when the
+creators list changes. It supports exact, prefix, substring and typo
+tolerant lookups:
+
+    index = CreatorIndex.for_site("https://kemono.su")
+    for user in index.search("belko", service="fanbox"):
+        print(user.name, user.id)
+"""
+import hashlib
+import os
+import time
+
+from bisect import bisect_left
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+from urllib.parse import urlparse
+
+import simplejson as json
+from loguru import logger
+
+from .cache import ResponseCache, get_cache
+from .user import User
+
+INDEX_VERSION = 1
+# Minimum trigram similarity for a typo tolerant match
+MIN_SIMILARITY = 0.3
+
+
+def normalize(value: str) -> str:
+    """Case fold and trim a name or query"""
+    return value.casefold().strip()
+
+
+def edit_distance(left: str, right: str) -> int:
+    """Levenshtein distance counting an adjacent swap as one edit"""
+    previous = None
+    current = list(range(len(right) + 1))
+    for i, lchar in enumerate(left, 1):
+        before, previous = previous, current
+        current = [i] + [0] * len(right)
+        for j, rchar in enumerate(right, 1):
+            current[j] = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (lchar != rchar),
+            )
+            if (
+                before
+                and i > 1
+                and j > 1
+                and lchar == right[j - 2]
+                and left[i - 2] == rchar
+            ):
+                current[j] = min(current[j], before[j - 2] + 1)
+    return current[-1]
+
+
+def allowed_edits(token: str) -> int:
+    """Typos tolerated in a query word, more for longer words"""
+    if len(token) < 4:
+        return 0
+    return 1 if len(token) < 7 else 2
+
+
+def token_similarity(query: str, name: str) -> Optional[float]:
+    """Every query word against its closest name word, None if one misses
+
+    A name word is also compared on its leading part, so an unfinished or
+    misspelt prefix such as "wondre" still finds "wonderland".
+    """
+    words = name.split()
+    scores = []
+    for token in query.split():
+        best = min(
+            min(
+                edit_distance(token, word),
+                edit_distance(token, word[: len(token)]) + 1,
+            )
+            for word in words
+        )
+        if best > allowed_edits(token):
+            return None
+        scores.append(1 - best / len(token))
+    return sum(scores) / len(scores) if scores else None
+
+
+def trigrams(value: str, pad: bool = True) -> Set[str]:
+    """Trigrams of a normalized string, padded to weight the word edges"""
+    if pad:
+        value = f"  {value} "
+    return {value[i : i + 3] for i in range(len(value) - 2)}
+
+
+class CreatorIndex:
+    """Ranked creator search backed by a trigram posting list
+
+    Attrs:
+        site: base url the creators were pulled from
+        creators: [id, name, service, indexed, updated] rows, timestamps as
+            epoch seconds
+        postings: trigram -> row numbers containing it
+    """
+
+    def __init__(
+        self,
+        site: str,
+        creators: List[list],
+        postings: Optional[Dict[str, List[int]]] = None,
+        fingerprint: Optional[str] = None,
+    ):
+        self.site = site
+        self.creators = creators
+        self.fingerprint = fingerprint or self.fingerprint_rows(creators)
+        self.names = [normalize(c[1]) for c in creators]
+        self.postings = postings or self._postings()
+        self.sorted_names = sorted(
+            (name, row) for row, name in enumerate(self.names)
+        )
+
+    def _postings(self) -> Dict[str, List[int]]:
+        output = {}
+        for row, name in enumerate(self.names):
+            for gram in trigrams(name):
+                output.setdefault(gram, []).append(row)
+        return output
+
+    @staticmethod
+    def rows(users: List[User]) -> List[list]:
+        """Compact index rows for User objects"""
+        return [
+            [
+                u.id,
+                u.name,
+                u.service,
+                u.indexed.timestamp(),
+                u.updated.timestamp(),
+            ]
+            for u in users
+        ]
+
+    @staticmethod
+    def fingerprint_rows(rows: List[list]) -> str:
+        """Hash of the creator rows, detects a changed creators list"""
+        return hashlib.sha1(json.dumps(rows).encode()).hexdigest()
+
+    @staticmethod
+    def filename(site: str, cache: Optional[ResponseCache] = None) -> str:
+        """Index location for a site, inside the response cache directory"""
+        cache = cache or get_cache()
+        host = urlparse(site).netloc or site
+        return os.path.join(cache.directory, "index", f"{host}.json")
+
+    def save(self, filename: str):
+        """Persist the index atomically"""
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        hold = f"{filename}.{os.getpid()}.tmp"
+        with open(hold, "w", encoding="utf-8") as file_:
+            json.dump(
+                dict(
+                    version=INDEX_VERSION,
+                    site=self.site,
+                    fingerprint=self.fingerprint,
+                    creators=self.creators,
+                    postings=self.postings,
+                ),
+                file_,
+            )
+        os.replace(hold, filename)
+
+    @classmethod
+    def load(cls, filename: str) -> Optional["CreatorIndex"]:
+        """Read a persisted index, None if missing or from another version"""
+        try:
+            with open(filename, encoding="utf-8") as file_:
+                data = json.load(file_)
+        except (OSError, ValueError):
+            return None
+        if data.get("version") != INDEX_VERSION:
+            return None
+        return cls(
+            data["site"],
+            data["creators"],
+            data["postings"],
+            data["fingerprint"],
+        )
+
+    @classmethod
+    def for_site(cls, site: str, refresh: bool = False) -> "CreatorIndex":
+        """Load the index for a site
+
+        An index younger than the cache ttl is used as is. Otherwise the
+        creators list is fetched through the response cache and the index is
+        only rebuilt if the list actually changed. With the cache disabled
+        the index is built in memory and never read from or written to disk.
+        """
+        cache = get_cache()
+        if not cache.enabled:
+            return cls(site, cls.rows(User.generate_users(site)))
+        filename = cls.filename(site, cache)
+        index = None if refresh else cls.load(filename)
+        if index and time.time() - os.stat(filename).st_mtime < cache.ttl:
+            return index
+        rows = cls.rows(User.generate_users(site))
+        if index and index.fingerprint == cls.fingerprint_rows(rows):
+            os.utime(filename)
+            return index
+        start = time.perf_counter()
+        index = cls(site, rows)
+        index.save(filename)
+        logger.debug(
+            f"Built creator index for {site} in "
+            f"{time.perf_counter() - start:.2f}s"
+        )
+        return index
+
+    def user(self, row: int) -> User:
+        """User object for an index row"""
+        id_, name, service, indexed, updated = self.creators[row]
+        return User(
+            id_,
+            name,
+            service,
+            indexed=datetime.fromtimestamp(indexed),
+            updated=datetime.fromtimestamp(updated),
+            site=self.site,
+        )
+
+    def _substring_rows(self, query: str) -> List[int]:
+        if len(query) < 3:
+            return [r for r, name in enumerate(self.names) if query in name]
+        grams = sorted(
+            trigrams(query, pad=False),
+            key=lambda g: len(self.postings.get(g, ())),
+        )
+        rows = set(self.postings.get(grams[0], ()))
+        for gram in grams[1:]:
+            rows.intersection_update(self.postings.get(gram, ()))
+            if not rows:
+                break
+        return [r for r in rows if query in self.names[r]]
+
+    def _prefix_rows(self, query: str) -> List[int]:
+        output = []
+        start = bisect_left(self.sorted_names, (query, -1))
+        for name, row in self.sorted_names[start:]:
+            if not name.startswith(query):
+                break
+            output.append(row)
+        return output
+
+    def _fuzzy_rows(self, query: str) -> Dict[int, float]:
+        grams = trigrams(query)
+        shared = Counter(
+            row for gram in grams for row in self.postings.get(gram, ())
+        )
+        output = {}
+        for row, count in shared.items():
+            total = len(grams) + len(trigrams(self.names[row])) - count
+            similarity = count / total
+            # Whole name overlap misses swapped or dropped letters in short
+            # words, so score word against word as well
+            words = token_similarity(query, self.names[row])
+            if words is not None:
+                similarity = max(similarity, words)
+            if similarity >= MIN_SIMILARITY:
+                output[row] = similarity
+        return output
+
+    def search(
+        self,
+        query: str,
+        service: Optional[str] = None,
+        limit: Optional[int] = 50,
+        fuzzy: bool = True,
+    ) -> List[User]:
+        """Ranked search over creator names
+
+        Exact matches rank first, then prefix, then substring, then typo
+        tolerant trigram matches ordered by similarity.
+        """
+        query = normalize(query)
+        if not query:
+            return []
+        tiers = {}
+        for row in self._substring_rows(query):
+            tiers[row] = (0 if self.names[row] == query else 2, 0)
+        for row in self._prefix_rows(query):
+            tiers[row] = min(tiers[row], (1, 0))
+        if fuzzy:
+            for row, similarity in self._fuzzy_rows(query).items():
+                tiers.setdefault(row, (3, -similarity))
+        rows = [
+            row
+            for row in tiers
+            if service is None or self.creators[row][2] == service
+        ]
+        rows.sort(key=lambda r: (*tiers[r], len(self.names[r]), self.names[r]))
+        return [self.user(row) for row in rows[:limit]]
@@ -0,0 +1,212 @@
+"""Split a download run across several worker processes
+
+Each worker runs download_async on its own event loop with its own
+connection pool. Workers never touch .etags or the run report; they hand
+their new etags, statuses and DownloadRecords back and the parent merges
+them, so there is a single writer for every shared file.
+"""
+import asyncio
+import multiprocessing
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+from urllib.parse import urlparse
+
+
+from .cache import configure_worker_cache
+from .common import get_etags, set_etags, add_etag, etag_exists
+from .logs import configure_worker_logging
+from .loop import run_async
+from .metrics import add_record, get_report, reset_report
+from .posts import Attachment
+from .profiling import phase
+from .progress import get_progress, render, reset_progress
+from .ratelimit import set_bandwidth, set_shares
+
+# files_done, bytes_done, bytes_total, active per worker slot
+FIELDS = 4
+SHARD_KEYS = ("size", "host")
+counters = None
+
+
+def host_key(file: Attachment) -> str:
+    """Group key for host sharding: the url host, or the hash prefix
+    directory the data mirrors are laid out by"""
+    parsed = urlparse(file.path)
+    return parsed.netloc or parsed.path.strip("/").split("/")[0]
+
+
+def partition(
+    files: List[Attachment], count: int, key: str = "size"
+) -> List[List[Attachment]]:
+    """Partition files into count shards
+
+    Args:
+        key: "size" balances known sizes longest first (unknown sizes count
+            as one unit, so they spread evenly); "host" keeps every file of a
+            host key on the same shard
+    """
+    if key not in SHARD_KEYS:
+        raise ValueError(f"Unknown shard key {key}, use one of {SHARD_KEYS}")
+    shards = [[] for _ in range(count)]
+    if key == "host":
+        for file in files:
+            shards[zlib.crc32(host_key(file).encode()) % count].append(file)
+        return shards
+    loads = [0] * count
+    for file in sorted(files, key=lambda x: x.size or 0, reverse=True):
+        index = loads.index(min(loads))
+        shards[index].append(file)
+        loads[index] += file.size or 1
+    return shards
+
+
+def _init_worker(shared):
+    """ProcessPoolExecutor initializer; keeps worker logs off the bar"""
+    global counters
+    counters = shared
+    configure_worker_logging()
+    configure_worker_cache()
+
+
+def _publish(slot: int):
+    progress = get_progress()
+    base = slot * FIELDS
+    counters[base] = progress.files_done
+    counters[base + 1] = progress.bytes_done
+    counters[base + 2] = progress.bytes_total
+    counters[base + 3] = progress.active
+
+
+async def _reporter(slot: int, interval: float = 0.25):
+    """Stand-in for the renderer inside workers, see download_async"""
+    try:
+        while True:
+            _publish(slot)
+            await asyncio.sleep(interval)
+    finally:
+        _publish(slot)
+
+
+def run_shard(
+    slot: int,
+    base_url: str,
+    directory: str,
+    files: List[Attachment],
+    workers: int,
+    full_check: bool,
+    size_limit: int,
+    etags: List[str],
+    bandwidth: Optional[int],
+    shares: int,
+    schedule: str = "post",
+):
+    """Worker entry point, returns statuses, new etags and records"""
+    # Imported here, cli imports this module
+    from .cli import download_async  # pylint: disable=import-outside-toplevel
+
+    # A pooled worker can be handed a second shard; report only this one
+    reset_report()
+    set_etags(etags)
+    set_shares(shares)
+    set_bandwidth(bandwidth)
+    statuses = run_async(
+        download_async(
+            base_url,
+            directory,
+            files,
+            workers,
+            full_check,
+            size_limit,
+            reporter=lambda: _reporter(slot),
+            schedule=schedule,
+        )
+    )
+    known = set(etags)
+    return dict(
+        statuses=statuses,
+        etags=[i for i in get_etags() if i not in known],
+        records=get_report().records,
+    )
+
+
+def _merge_counters(shared):
+    progress = get_progress()
+    for index, field in enumerate(
+        ("files_done", "bytes_done", "bytes_total", "active")
+    ):
+        setattr(progress, field, sum(shared[index::FIELDS]))
+
+
+async def _collect(pool, shards, shared, args, headless):
+    loop = asyncio.get_running_loop()
+    reset_progress(sum(len(i) for i in shards))
+    futures = [
+        loop.run_in_executor(
+            pool, run_shard, slot, *args[:2], shard, *args[2:]
+        )
+        for slot, shard in enumerate(shards)
+        if shard
+    ]
+    renderer = asyncio.create_task(render(headless=headless))
+    gathered = asyncio.gather(*futures)
+    try:
+        while not gathered.done():
+            _merge_counters(shared)
+            await asyncio.wait([gathered], timeout=0.25)
+        return gathered.result()
+    finally:
+        _merge_counters(shared)
+        renderer.cancel()
+        await asyncio.gather(renderer, return_exceptions=True)
+
+
+def download_sharded(
+    base_url: str,
+    directory: str,
+    files: List[Attachment],
+    workers: int = 10,
+    full_check: bool = False,
+    size_limit: int = -1,
+    headless: bool = False,
+    processes: int = 2,
+    key: str = "size",
+    bandwidth: Optional[int] = None,
+    schedule: str = "post",
+):
+    """Run download_async across processes and merge the results back
+
+    workers and bandwidth (bytes per second) are totals and are split evenly
+    between processes.
+    """
+    shards = partition(files, processes, key)
+    context = multiprocessing.get_context("spawn")
+    shared = context.Array("q", processes * FIELDS, lock=False)
+    args = (
+        base_url,
+        directory,
+        max(workers // processes, 1),
+        full_check,
+        size_limit,
+        list(get_etags()),
+        bandwidth,
+        processes,
+        schedule,
+    )
+    with ProcessPoolExecutor(
+        processes,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(shared,),
+    ) as pool, phase("downloads"):
+        results = run_async(_collect(pool, shards, shared, args, headless))
+    output = []
+    for result in results:
+        output.extend(result["statuses"])
+        for tag in result["etags"]:
+            if not etag_exists(tag):
+                add_etag(tag)
+        for record in result["records"]:
+            add_record(record)
+    return output
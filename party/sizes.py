@@ -0,0 +1,79 @@
+"""Content length discovery for attachments ahead of downloading"""
+import asyncio
+
+from collections import Counter, defaultdict
+from typing import List, Optional
+
+import aiohttp
+
+from .cache import get_size_cache
+from .logs import error_event
+from .metrics import SIZE_BUCKETS, Histogram
+from .posts import Attachment
+from .profiling import phase
+
+
+async def head_size(client, file: Attachment) -> Optional[int]:
+    """HEAD an attachment and return its content length, if reported"""
+    try:
+        async with client.head(file.url, allow_redirects=True) as head:
+            if "content-length" in head.headers:
+                return int(head.headers["content-length"])
+    except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+        error_event("head failed", client.base_url, error=err, url=file.path)
+    return None
+
+
+async def head_sizes(
+    client, files: List[Attachment], workers: int = 16
+) -> List[Attachment]:
+    """Fill in Attachment.size with bounded concurrent HEAD requests
+
+    Files that already know their size are left alone, the size cache is
+    checked before any request and holds every size learned.
+    """
+    cache = get_size_cache()
+    semaphore = asyncio.Semaphore(workers)
+
+    async def size(file):
+        async with semaphore:
+            file.size = await head_size(client, file)
+        cache.put(file.path, file.size)
+
+    for file in files:
+        if file.size is None:
+            file.size = cache.get(file.path)
+    with phase("sizing"):
+        await asyncio.gather(*(size(f) for f in files if f.size is None))
+        await asyncio.to_thread(cache.save)
+    return files
+
+
+def summarize_sizes(files: List[Attachment]) -> dict:
+    """Totals, per extension breakdown and a size histogram
+
+    Files sharing a path are counted once.
+    """
+    unique = {f.path: f for f in files}.values()
+    extensions = defaultdict(Counter)
+    histogram = Histogram(SIZE_BUCKETS)
+    for file in unique:
+        ext = extensions[file.extension.lower()]
+        ext["files"] += 1
+        if file.size is None:
+            ext["unknown"] += 1
+            continue
+        ext["bytes"] += file.size
+        histogram.observe(file.size)
+    return dict(
+        files=len(unique),
+        bytes=sum(i["bytes"] for i in extensions.values()),
+        unknown=sum(i["unknown"] for i in extensions.values()),
+        extensions={
+            k: dict(v)
+            for k, v in sorted(
+                extensions.items(), key=lambda x: x[1]["bytes"], reverse=True
+            )
+        },
+        histogram=histogram,
+    )
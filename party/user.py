@@ -1,23 +1,30 @@
 """Basic storage and serialization for user objects"""
 # import json
 
+import asyncio
+import os
+
+from contextlib import aclosing
 from dataclasses import dataclass
 from datetime import datetime
 from functools import cached_property
+from itertools import islice
 
 from numbers import Number
-from typing import Iterator, List, Optional
-
-# from urllib3.exceptions import ConnectTimeoutError
+from typing import AsyncIterator, Iterator, List, Optional
 
-import requests
 import simplejson as json
 from loguru import logger
 from marshmallow import Schema, fields, post_load, EXCLUDE, pre_load
-from requests.adapters import Retry, HTTPAdapter
+
+from .cache import get_cache
+from .client import PartyClient, iterate_with_client, run_with_client
+from .filters import PostFilter
+from .listing import ListingCheckpoint
 
 # from .notes import populate_posts
 from .posts import Post, PostSchema
+from .profiling import phase
 
 
 @dataclass
@@ -43,17 +50,19 @@ class User:
         return output
 
     @staticmethod
-    def generate_users(base_url):
+    async def agenerate_users(client: PartyClient):
+        """Return all User objects from the client's site"""
+        body = await get_cache().fetch(
+            client, f"{client.base_url}/api/v1/creators.txt", timeout=90
+        )
+        return UserSchema(
+            context={"site": client.base_url}, unknown=EXCLUDE
+        ).loads(body, many=True)
+
+    @classmethod
+    def generate_users(cls, base_url):
         """Generator to return all User objects from a base_url"""
-        with requests.Session() as session:
-            retries = Retry(total=5, backoff_factor=0.2)
-            session.mount("https://", HTTPAdapter(max_retries=retries))
-            resp = session.get(
-                f"{base_url}/api/v1/creators.txt", timeout=90, stream=True
-            )
-            return UserSchema(
-                context={"site": base_url}, unknown=EXCLUDE
-            ).loads(resp.text, many=True)
+        return run_with_client(base_url, cls.agenerate_users)
 
     @staticmethod
     def return_user(users, service: str, search: str, attr: str):
@@ -67,7 +76,19 @@ class User:
                 and getattr(i, attr).lower() == search.lower()
             ):
                 return i
-        raise StopIteration
+        raise LookupError(f"No {service} user with {attr} {search}")
+
+    @classmethod
+    async def aget_user(cls, client: PartyClient, service: str, search: str):
+        """Async get_user on an open client"""
+        with phase("lookup"):
+            users = await cls.agenerate_users(client)
+            try:
+                attr = "id"
+                return cls.return_user(users, service, search, attr)
+            except LookupError:
+                attr = "name"
+                return cls.return_user(users, service, search, attr)
 
     @classmethod
     def get_user(cls, base_url: str, service: str, search: str):
@@ -79,42 +100,73 @@ class User:
             search: user id or user name
         Returns:
             User
+        Raises:
+            LookupError: no user matched
         """
-        users = cls.generate_users(base_url)
-        try:
-            attr = "id"
-            return cls.return_user(users, service, search, attr)
-        except StopIteration:
-            attr = "name"
-            return cls.return_user(users, service, search, attr)
+        return run_with_client(
+            base_url, lambda client: cls.aget_user(client, service, search)
+        )
 
-    def generate_posts(self, raw: bool = False) -> Iterator[Post]:
-        """Generator for Posts from this user
+    async def agenerate_posts(
+        self,
+        client: PartyClient,
+        raw: bool = False,
+        filter_: Optional[PostFilter] = None,
+    ) -> AsyncIterator[Post]:
+        """Async generator for Posts from this user, see generate_posts
 
-        Yields:
-            Post
+        With a directory set, fetched pages are checkpointed to
+        {directory}/.listing. A listing that dies part way resumes from the
+        last good page on the next call; the checkpoint is removed once the
+        listing finishes or the caller stops early.
         """
         schema = PostSchema(unknown=EXCLUDE)
+        checkpoint = (
+            ListingCheckpoint(self.directory, self.url)
+            if self.directory
+            else None
+        )
+        resumed = checkpoint.resume() if checkpoint else []
+        if resumed:
+            logger.info(
+                f"Resuming listing from {checkpoint.filename}: "
+                f"{len(resumed)} pages already fetched"
+            )
+        # New posts shift offsets between runs, skip repeats across the seam
+        seen = set()
         offset = 0
-        with requests.Session() as session:
-            retries = Retry(total=5, backoff_factor=0.2)
-            session.mount("https://", HTTPAdapter(max_retries=retries))
+        failed = False
+        try:
             while True:
                 if offset != 0 and offset % 50 != 0:
                     break
-                resp = session.get(
-                    self.url, params={"o": offset, "limit": 50}, timeout=60
-                )
-                logger.debug(resp.url)
-                try:
-                    posts = resp.json()
-                    if not posts:
-                        break
-                except requests.exceptions.JSONDecodeError as err:
-                    print(resp.request.url)
-                    raise err
+                if resumed:
+                    _, posts = resumed.pop(0)
+                else:
+                    params = {"o": offset, "limit": 50}
+                    body = await get_cache().fetch(
+                        client, self.url, params, timeout=60
+                    )
+                    try:
+                        posts = json.loads(body)
+                    except json.JSONDecodeError as err:
+                        print(f"{self.url}?o={offset}")
+                        raise err
+                    if posts and checkpoint:
+                        checkpoint.append(offset, posts)
+                if not posts:
+                    break
                 for post in posts:
                     offset += 1
+                    if checkpoint:
+                        if post["id"] in seen:
+                            continue
+                        seen.add(post["id"])
+                    if filter_:
+                        if filter_.past_window(post):
+                            return
+                        if not filter_.accepts_post(post):
+                            continue
                     if raw:
                         yield post
                     else:
@@ -123,6 +175,47 @@ class User:
                         except:
                             logger.debug(post)
                             raise
+        except (Exception, asyncio.CancelledError):
+            failed = True
+            raise
+        finally:
+            if checkpoint and not failed:
+                checkpoint.clear()
+
+    async def alimit_posts(
+        self,
+        client: PartyClient,
+        limit: Optional[int] = None,
+        filter_: Optional[PostFilter] = None,
+    ) -> List[Post]:
+        """Async limit_posts on an open client, no limit lists everything"""
+        output = []
+        with phase("listing"):
+            async with aclosing(
+                self.agenerate_posts(client, filter_=filter_)
+            ) as gen:
+                async for post in gen:
+                    output.append(post)
+                    if limit and len(output) >= limit:
+                        break
+        return output
+
+    def generate_posts(
+        self, raw: bool = False, filter_: Optional[PostFilter] = None
+    ) -> Iterator[Post]:
+        """Generator for Posts from this user
+
+        Args:
+            raw: yield the api dicts instead of Post objects
+            filter_: skip posts outside the filter, and stop paginating once
+                the listing is older than its published window
+        Yields:
+            Post
+        """
+        return iterate_with_client(
+            self.site,
+            lambda client: self.agenerate_posts(client, raw, filter_),
+        )
 
     def for_json(self):
         """JSON convert method for simplejson
@@ -132,32 +225,41 @@ class User:
         """
         return UserSchema().dump(self)
 
-    def limit_posts(self, limit: Optional[int] = None) -> Iterator[Post]:
+    def limit_posts(
+        self,
+        limit: Optional[int] = None,
+        filter_: Optional[PostFilter] = None,
+    ) -> List[Post]:
         """Limit the number of posts pulled, this will restrict the number of API calls
 
         Args:
             limit: number of posts to check
-        Yields:
-            Post
+            filter_: passed through to generate_posts
+        Returns:
+            List[Post]
         """
-        gen = self.generate_posts()
-        return [next(gen, None) for _ in range(limit)]
+        return list(islice(self.generate_posts(filter_=filter_), limit))
 
     def write_info(self, options: Optional[dict] = None) -> None:
         """Write out user details for pull options
 
+        Other top level keys already in .info, such as watch settings, are
+        kept.
+
         Args:
             options: The cli options used or None
         """
-        with open(
-            f"{self.directory}/.info", "w", encoding="utf-8"
-        ) as info_out:
-            info_out.write(
-                json.dumps(
-                    {"user": self, "options": options},
-                    for_json=True,
-                )
-            )
+        filename = f"{self.directory}/.info"
+        info = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename, encoding="utf-8") as info_in:
+                    info = json.load(info_in)
+            except json.JSONDecodeError:
+                info = {}
+        info.update(user=self, options=options)
+        with open(filename, "w", encoding="utf-8") as info_out:
+            info_out.write(json.dumps(info, for_json=True))
 
     @cached_property
     def posts(self) -> List[Post]:
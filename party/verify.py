@@ -0,0 +1,157 @@
+"""Offline integrity checks against the sha256 in party data paths
+
+Files under /data are stored by content hash, /ab/cd/<sha256>.ext, so a
+download can be checked with nothing but the path and the bytes on disk.
+"""
+import hashlib
+import mmap
+import os
+import re
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import simplejson as json
+
+HASH_RE = re.compile(r"([0-9a-f]{64})(?:\.[^/]*)?$")
+# Below this many files the pool costs more than it saves
+POOL_THRESHOLD = 32
+
+verify_downloads = os.environ.get("PARTY_VERIFY", "") == "1"
+
+
+def get_verify_downloads() -> bool:
+    """Whether finished downloads are hashed against their path"""
+    return verify_downloads
+
+
+def set_verify_downloads(value: bool):
+    """Toggle the post-download hook, exported so spawned workers inherit
+    it"""
+    global verify_downloads
+    verify_downloads = value
+    os.environ["PARTY_VERIFY"] = "1" if value else ""
+
+
+def path_hash(path: str) -> Optional[str]:
+    """The sha256 a data path promises, None for paths without one"""
+    match = HASH_RE.search(path or "")
+    return match.group(1) if match else None
+
+
+def hash_file(filename: str) -> str:
+    """sha256 of a file, read through mmap so the page cache does the IO"""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as file_:
+        if os.fstat(file_.fileno()).st_size:
+            with mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                digest.update(data)
+    return digest.hexdigest()
+
+
+def check_file(filename: str, path: str) -> Optional[bool]:
+    """True or False for a hash match, None when the path has no hash"""
+    expected = path_hash(path)
+    if expected is None:
+        return None
+    return hash_file(filename) == expected
+
+
+def _check(item: Tuple[str, str]) -> Tuple[str, Optional[bool]]:
+    filename, path = item
+    try:
+        return filename, check_file(filename, path)
+    except OSError:
+        return filename, False
+
+
+class VerifyCache:
+    """Size and mtime of files that already passed, in {directory}/.verified
+
+    A file whose size and mtime are unchanged since it passed is not hashed
+    again.
+    """
+
+    def __init__(self, directory: str):
+        self.filename = f"{directory}/.verified"
+        self.entries: Dict[str, List[int]] = {}
+        if os.path.exists(self.filename):
+            with open(self.filename, encoding="utf-8") as file_:
+                self.entries = json.load(file_)
+
+    @staticmethod
+    def key(stat: os.stat_result) -> List[int]:
+        """Fingerprint stored per file"""
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def fresh(self, filename: str, stat: os.stat_result) -> bool:
+        """Whether filename passed before and is unchanged since"""
+        return self.entries.get(filename) == self.key(stat)
+
+    def mark(self, filename: str, stat: os.stat_result):
+        """Record a passing file"""
+        self.entries[filename] = self.key(stat)
+
+    def discard(self, filename: str):
+        """Forget a file"""
+        self.entries.pop(filename, None)
+
+    def save(self):
+        """Write the cache atomically"""
+        hold = f"{self.filename}.{os.getpid()}.tmp"
+        with open(hold, "w", encoding="utf-8") as file_:
+            json.dump(self.entries, file_)
+        os.replace(hold, self.filename)
+
+
+def verify_paths(
+    directory: str,
+    items: Iterable[Tuple[str, str]],
+    processes: Optional[int] = None,
+    use_cache: bool = True,
+) -> Dict[str, List[str]]:
+    """Hash (filename, path) pairs under directory against their paths
+
+    Args:
+        items: filename relative to directory, and its data path
+        processes: hashing processes, defaults to the cpu count
+        use_cache: skip files recorded in .verified with the same stat
+    Returns:
+        filenames grouped into ok, cached, mismatch, missing and unhashed
+    """
+    cache = VerifyCache(directory)
+    output = {
+        k: [] for k in ("ok", "cached", "mismatch", "missing", "unhashed")
+    }
+    pending = []
+    names = {}
+    stats = {}
+    for filename, path in items:
+        full = f"{directory}/{filename}"
+        try:
+            stats[filename] = os.stat(full)
+        except FileNotFoundError:
+            output["missing"].append(filename)
+            continue
+        if use_cache and cache.fresh(filename, stats[filename]):
+            output["cached"].append(filename)
+            continue
+        names[full] = filename
+        pending.append((full, path))
+    if len(pending) >= POOL_THRESHOLD and processes != 1:
+        with ProcessPoolExecutor(processes) as pool:
+            results = list(pool.map(_check, pending, chunksize=8))
+    else:
+        results = [_check(i) for i in pending]
+    for full, result in results:
+        filename = names[full]
+        if result is None:
+            output["unhashed"].append(filename)
+        elif result:
+            cache.mark(filename, stats[filename])
+            output["ok"].append(filename)
+        else:
+            cache.discard(filename)
+            output["mismatch"].append(filename)
+    cache.save()
+    return output
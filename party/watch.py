@@ -0,0 +1,380 @@
+"""Long running watch mode for a set of pulled creators
+
+One process keeps a warm PartyClient per site, polls every managed creator
+on its own interval with jitter, and feeds the files of new posts into a
+single download queue. Each creator keeps its own directory, .posts and
+.etags, exactly as update would leave them.
+"""
+import asyncio
+import glob
+import os
+import random
+import signal
+import sys
+import time
+
+from collections import Counter
+from contextlib import aclosing
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import simplejson as json
+from loguru import logger
+
+from .client import PartyClient
+from .common import StatusEnum, scope_etags, update_csluglify
+from .extract import load_cached_posts
+from .filters import PostFilter
+from .metrics import reset_report
+from .posts import PostSchema
+from .progress import get_progress, human_bytes, render, reset_progress
+from .ratelimit import watch_bandwidth_file
+from .user import User
+
+DEFAULT_INTERVAL = 60 * 60
+
+
+def _dump_atomic(filename: str, data):
+    hold = f"{filename}.{os.getpid()}.tmp"
+    with open(hold, "w", encoding="utf-8") as file_:
+        json.dump(data, file_, for_json=True)
+    os.replace(hold, filename)
+
+
+@dataclass
+class Creator:
+    """A creator directory under watch
+
+    Attrs:
+        directory: output folder holding the .info file
+        options: pull options from .info
+        interval: seconds between polls, .info may set watch.interval
+        etags: this directory's etag cache, scoped in while its files download
+        posts: cached posts, newest first, as written to .posts
+        known: ids of the cached posts, listing stops at the first one
+        pending: queued files that have not finished yet
+        unsaved: posts holds new posts whose files are still downloading;
+            .posts is only rewritten once pending drains, so a killed
+            daemon lists them again on restart
+    """
+
+    directory: str
+    user: User
+    options: dict
+    interval: float
+    etags: list = field(default_factory=list)
+    posts: list = field(default_factory=list)
+    known: set = field(default_factory=set)
+    next_poll: float = 0.0
+    last_poll: Optional[float] = None
+    last_error: Optional[str] = None
+    pending: int = 0
+    unsaved: bool = False
+    statuses: Counter = field(default_factory=Counter)
+
+    @classmethod
+    def load(cls, directory: str, interval: float = DEFAULT_INTERVAL):
+        """Build a Creator from a pulled directory"""
+        with open(f"{directory}/.info", encoding="utf-8") as info:
+            settings = json.load(info)
+        options = settings["options"]
+        # backwards compatible with old options, as update is
+        if "ignore_extensions" in options:
+            options["exclude_extensions"] = options.pop("ignore_extensions")
+        if "base_url" in options:
+            options["site"] = options.pop("base_url")
+        data = settings["user"]
+        user = User(data["id"], data["name"], data["service"])
+        user.site = options["site"]
+        # Kept outside options, which update passes to pull_user
+        watch = settings.get("watch") or {}
+        creator = cls(
+            directory, user, options, watch.get("interval", interval)
+        )
+        if os.path.exists(f"{directory}/.etags"):
+            with open(f"{directory}/.etags", encoding="utf-8") as file_:
+                creator.etags = json.load(file_)
+        creator.posts = load_cached_posts(directory) or []
+        creator.known = {p["id"] for p in creator.posts}
+        return creator
+
+    @property
+    def site(self) -> str:
+        """Site the creator was pulled from"""
+        return self.user.site
+
+    @property
+    def post_filter(self) -> PostFilter:
+        """Filter built from the saved pull options"""
+        return PostFilter(
+            **{
+                k: v
+                for k, v in self.options.items()
+                if k in PostFilter.__dataclass_fields__
+            }
+        )
+
+    def save_etags(self):
+        """Write this creator's etag cache"""
+        _dump_atomic(f"{self.directory}/.etags", self.etags)
+
+    def save_posts(self):
+        """Write the cached posts, new ones included"""
+        _dump_atomic(f"{self.directory}/.posts", self.posts)
+        self.unsaved = False
+
+    def settle(self):
+        """Persist etags, and posts if new ones are waiting, once the
+        creator has no files in flight"""
+        if self.pending:
+            return
+        self.save_etags()
+        if self.unsaved:
+            self.save_posts()
+
+    def for_json(self):
+        """Simplejson export method, used for the status file"""
+        return dict(
+            name=self.user.name,
+            service=self.user.service,
+            directory=self.directory,
+            interval=self.interval,
+            last_poll=self.last_poll,
+            next_poll=self.next_poll,
+            last_error=self.last_error,
+            pending=self.pending,
+            posts=len(self.posts),
+            statuses=self.statuses,
+        )
+
+
+def find_creators(
+    folders: List[str], interval: float = DEFAULT_INTERVAL
+) -> List[Creator]:
+    """Creators from folders holding a .info, or from their subfolders"""
+    output = []
+    for folder in folders:
+        if os.path.exists(f"{folder}/.info"):
+            infos = [f"{folder}/.info"]
+        else:
+            infos = sorted(glob.glob(f"{folder}/*/.info"))
+        for info in infos:
+            try:
+                output.append(Creator.load(os.path.dirname(info), interval))
+            except (OSError, KeyError, json.JSONDecodeError) as err:
+                logger.warning(f"Skipping {info}: {err}")
+    return output
+
+
+class Watcher:
+    """Poll creators and download their new posts until cancelled
+
+    Attrs:
+        creators: creators under watch
+        workers: concurrent downloads shared by every creator
+        jitter: fraction each poll interval is randomly stretched or cut by
+        status_file: json status rewritten every status_interval seconds
+        bandwidth_file: control file polled for a new bandwidth limit
+        once: poll every creator a single time, drain the queue and return
+    """
+
+    def __init__(
+        self,
+        creators: List[Creator],
+        workers: int = 8,
+        jitter: float = 0.1,
+        status_file: Optional[str] = None,
+        status_interval: float = 5,
+        full_check: bool = False,
+        once: bool = False,
+        bandwidth_file: Optional[str] = None,
+    ):
+        self.creators = creators
+        self.workers = workers
+        self.jitter = jitter
+        self.status_file = status_file
+        self.status_interval = status_interval
+        self.full_check = full_check
+        self.once = once
+        self.bandwidth_file = bandwidth_file
+        self.clients: Dict[str, PartyClient] = {}
+        self.queue: Optional[asyncio.Queue] = None
+        self.started = time.time()
+
+    async def client(self, site: str) -> PartyClient:
+        """One warm client per site, opened on first use"""
+        if site not in self.clients:
+            self.clients[site] = await PartyClient(
+                site, limit_per_host=self.workers
+            ).open()
+        return self.clients[site]
+
+    async def poll(self, creator: Creator):
+        """List posts newer than the cache and queue their files"""
+        # Imported here, cli imports this module
+        from .cli import name_files  # pylint: disable=import-outside-toplevel
+
+        client = await self.client(creator.site)
+        new = []
+        async with aclosing(
+            creator.user.agenerate_posts(client, filter_=creator.post_filter)
+        ) as gen:
+            async for post in gen:
+                if post.id in creator.known:
+                    break
+                new.append(post)
+        if not new:
+            logger.debug(f"{creator.user.name}: no new posts")
+            return
+        creator.posts = [p.for_json() for p in new] + creator.posts
+        creator.known.update(p.id for p in new)
+        creator.unsaved = True
+        # Name against the whole history so names match a full update
+        options = creator.options
+        update_csluglify(options.get("sluglify", False))
+        files = name_files(
+            PostSchema(many=True).load(creator.posts),
+            options.get("files", True),
+            creator.post_filter,
+            options.get("file_format", "{ref.filename}"),
+            options.get("ordered_short", False),
+            options.get("exclude_external", True),
+        )
+        fresh = {p.id for p in new}
+        files = [f for f in files if f.post_id in fresh]
+        logger.info(
+            f"{creator.user.name}: {len(new)} new posts, {len(files)} files"
+        )
+        get_progress().files_total += len(files)
+        creator.pending += len(files)
+        for ref in files:
+            self.queue.put_nowait((creator, ref))
+        creator.settle()
+
+    async def watch_creator(self, creator: Creator):
+        """Poll one creator on its interval"""
+        while True:
+            delay = creator.next_poll - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await self.poll(creator)
+                creator.last_error = None
+            except Exception as err:  # pylint: disable=broad-except
+                # A daemon outlives one creator's bad page or challenge
+                creator.last_error = f"{err!r}"
+                logger.warning(f"{creator.user.name}: poll failed, {err!r}")
+            creator.last_poll = time.time()
+            if self.once:
+                return
+            spread = random.uniform(-self.jitter, self.jitter)
+            creator.next_poll = creator.last_poll + creator.interval * (
+                1 + spread
+            )
+
+    async def download(self):
+        """Queue consumer, one per worker"""
+        progress = get_progress()
+        while True:
+            creator, ref = await self.queue.get()
+            scope_etags(creator.etags)
+            progress.active += 1
+            filename = f"{creator.directory}/{ref.filename}"
+            # Files of new posts only exist if a killed run left them
+            # partial; resume those rather than calling them done
+            full_check = self.full_check or os.path.exists(filename)
+            try:
+                try:
+                    status = await ref.download(
+                        await self.client(creator.site),
+                        filename,
+                        0,
+                        full_check,
+                        creator.options.get("size_limit", -1),
+                    )
+                except Exception as err:  # pylint: disable=broad-except
+                    # One bad file must not take a shared worker down
+                    status = StatusEnum.ERROR_OTHER
+                    logger.warning(
+                        f"{creator.user.name}: {ref.filename} failed, {err!r}"
+                    )
+                creator.statuses[f"{status}"] += 1
+            finally:
+                progress.active -= 1
+                progress.files_done += 1
+                creator.pending -= 1
+                creator.settle()
+                self.queue.task_done()
+
+    def status(self) -> dict:
+        """Queue depth, throughput and per-creator state"""
+        progress = get_progress()
+        return dict(
+            updated=time.time(),
+            started=self.started,
+            queue=self.queue.qsize(),
+            active=progress.active,
+            files_done=progress.files_done,
+            files_total=progress.files_total,
+            bytes_done=progress.bytes_done,
+            throughput=progress.rate,
+            throughput_human=f"{human_bytes(progress.rate)}/s",
+            creators=self.creators,
+        )
+
+    def write_status(self):
+        """Rewrite the status file, if one is configured"""
+        if self.status_file:
+            _dump_atomic(self.status_file, self.status())
+
+    async def report(self):
+        """Keep the status file fresh
+
+        Per-creator statuses carry the totals, so the run report's records
+        are dropped each cycle instead of piling up for the life of the
+        daemon.
+        """
+        while True:
+            self.write_status()
+            reset_report(mode="watch")
+            await asyncio.sleep(self.status_interval)
+
+    async def run(self):
+        """Watch until cancelled, or one pass when once is set"""
+        reset_progress(0)
+        self.queue = asyncio.Queue()
+        if sys.platform != "win32":
+            # Stop cleanly under service managers as well as on ctrl-c
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, asyncio.current_task().cancel
+            )
+        for creator in self.creators:
+            # Spread the first polls out so a restart is not a burst
+            window = 0 if self.once else self.jitter * creator.interval
+            creator.next_poll = time.time() + random.uniform(0, window)
+        background = [
+            asyncio.create_task(self.download()) for _ in range(self.workers)
+        ]
+        background.append(asyncio.create_task(self.report()))
+        if self.bandwidth_file:
+            background.append(
+                asyncio.create_task(watch_bandwidth_file(self.bandwidth_file))
+            )
+        background.append(asyncio.create_task(render(headless=True)))
+        try:
+            await asyncio.gather(
+                *(self.watch_creator(c) for c in self.creators)
+            )
+            await self.queue.join()
+        finally:
+            for task in background:
+                task.cancel()
+            await asyncio.gather(*background, return_exceptions=True)
+            for creator in self.creators:
+                # Posts with files still pending stay out of .posts
+                creator.save_etags()
+                if not creator.pending and creator.unsaved:
+                    creator.save_posts()
+            self.write_status()
+            for client in self.clients.values():
+                await client.close()